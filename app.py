@@ -1,17 +1,41 @@
 from flask import Flask, request, jsonify, render_template, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import requests
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import ParseError
-from datetime import datetime, timedelta
-import time, json, os, csv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+import time, json, os, sys, csv, math, socket, threading, gzip, zlib, itertools, asyncio, queue, hashlib
+import functools, multiprocessing
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, Future, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from io import StringIO
-from collections import defaultdict, Counter
-from typing import Dict, List, Optional
+from collections import defaultdict, deque, OrderedDict
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from typing import Dict, Iterable, List, Optional
 import pytz
 import sqlite3
 
+try:
+    import aiohttp
+except ImportError:  # async crawl mode is optional
+    aiohttp = None
+try:
+    import orjson
+except ImportError:  # faster JSON encoding is optional
+    orjson = None
+try:
+    import brotli
+except ImportError:  # br response encoding is optional
+    brotli = None
+
 # Flask app initialization
 app = Flask(__name__)
 CORS(app)
@@ -19,17 +43,271 @@ CORS(app)
 # Legacy JSON history file for migration
 HISTORY_FILE = 'crawl_history.json'
 
+# Sessions coalesced into one write transaction by the history writer
+HISTORY_WRITE_BATCH = 200
+# Session ids per IN (...) query when loading child rows
+HISTORY_IN_CHUNK = 500
+# Rows fetched from SQLite (and flushed to the client) per export step
+EXPORT_BATCH_SIZE = 500
+# Session timestamps are wall-clock strings in this zone; started_at keeps
+# the same instant as a UTC epoch (the zone has no DST, so a fixed offset)
+HISTORY_TZ = pytz.timezone("Asia/Ho_Chi_Minh")
+HISTORY_UTC_OFFSET = 7 * 3600
+
+def history_day_start(day: str) -> int:
+    """UTC epoch of the local midnight that starts a YYYY-MM-DD history day"""
+    try:
+        start = datetime.strptime(day, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValueError(f"Ngày không hợp lệ: {day}")
+    return int(HISTORY_TZ.localize(start).timestamp())
+
+def parse_history_timestamp(text: str) -> Optional[datetime]:
+    """Aware HISTORY_TZ datetime of a stored or migrated timestamp, None if unreadable"""
+    try:
+        parsed = datetime.fromisoformat(str(text).strip())
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        return HISTORY_TZ.localize(parsed)
+    return parsed.astimezone(HISTORY_TZ)
+
+def url_fingerprint(url: str) -> int:
+    """Signed 64-bit BLAKE2b fingerprint of a URL (fits an SQLite INTEGER)"""
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(),
+                          'big', signed=True)
+
+def encode_url_bitmap(ordinals) -> bytes:
+    """zlib-compressed bitmap with bit n (little-endian) set for each ordinal n"""
+    ordinals = list(ordinals)
+    bitmap = bytearray((max(ordinals) >> 3) + 1 if ordinals else 0)
+    for ordinal in ordinals:
+        bitmap[ordinal >> 3] |= 1 << (ordinal & 7)
+    return zlib.compress(bytes(bitmap))
+
+def iter_bitmap_ordinals(bitmap: bytes):
+    """Yield the ordinals whose bits are set in an uncompressed bitmap"""
+    for index, byte in enumerate(bitmap):
+        if byte:
+            base = index << 3
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield base + bit
+
+# Prometheus-style metrics
+# Default histogram buckets, in seconds
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _metric_labels(label: Optional[str], value) -> str:
+    return f'{{{label}="{value}"}}' if label else ''
+
+class MetricCounter:
+    """Monotonic counter, optionally split by one label"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name: str, help_text: str, label: str = None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+    
+    def inc(self, value=1, label_value: str = None):
+        with self._lock:
+            self._values[label_value] += value
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: str(item[0]))
+        if not values and not self.label:
+            values = [(None, 0)]
+        return [f"{self.name}{_metric_labels(self.label, key)} {value:g}" for key, value in values]
+
+class Gauge(MetricCounter):
+    """Current value, set by inc/dec or read from a callback at scrape time"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name: str, help_text: str, label: str = None, callback=None):
+        super().__init__(name, help_text, label)
+        self.callback = callback
+    
+    def dec(self, value=1, label_value: str = None):
+        self.inc(-value, label_value)
+    
+    def samples(self) -> List[str]:
+        if self.callback is None:
+            return super().samples()
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return [f"{self.name} {value:g}"]
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by one label
+
+    observe() is a bisect plus a short locked update, cheap enough for
+    every request and sitemap document.
+    """
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, label: str = 'outcome',
+                 buckets: tuple = METRIC_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, label_value: str = 'ok'):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # One slot per bucket plus +Inf, then the running sum
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+        lines = []
+        for key in sorted(snapshot, key=str):
+            series = snapshot[key]
+            prefix = f'{self.label}="{key}",' if self.label else ''
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {total}')
+            labels = _metric_labels(self.label, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:g}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+class MetricsRegistry:
+    """Process-wide metrics rendered in the Prometheus text format by /metrics"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, help_text: str, label: str = None) -> MetricCounter:
+        return self.register(MetricCounter(name, help_text, label))
+    
+    def gauge(self, name: str, help_text: str, label: str = None, callback=None) -> Gauge:
+        return self.register(Gauge(name, help_text, label, callback))
+    
+    def histogram(self, name: str, help_text: str, label: str = 'outcome', **kwargs) -> Histogram:
+        return self.register(Histogram(name, help_text, label, **kwargs))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+http_connect_seconds = metrics.histogram(
+    'sitemap_http_connect_seconds', 'DNS + TCP/TLS connect time of new HTTP connections')
+http_ttfb_seconds = metrics.histogram(
+    'sitemap_http_ttfb_seconds', 'Time from sending a request to its response headers')
+download_seconds = metrics.histogram(
+    'sitemap_download_seconds', 'Time spent reading one sitemap body')
+download_bytes = metrics.counter(
+    'sitemap_download_bytes_total', 'Sitemap body bytes read off the wire')
+parse_seconds = metrics.histogram(
+    'sitemap_parse_seconds', 'Time spent gunzipping and parsing one sitemap body')
+db_write_seconds = metrics.histogram(
+    'sitemap_db_write_seconds', 'Duration of one history write transaction')
+db_written_sessions = metrics.counter(
+    'sitemap_db_written_sessions_total', 'Crawl sessions committed by the history writer')
+sqlite_lock_wait_seconds = metrics.histogram(
+    'sitemap_sqlite_lock_wait_seconds', 'Wait for the SQLite write lock (BEGIN IMMEDIATE)',
+    label='db')
+sqlite_lock_waiters = metrics.gauge(
+    'sitemap_sqlite_lock_waiters', 'Threads currently waiting for the SQLite write lock')
+domains_in_flight = metrics.gauge(
+    'sitemap_domains_in_flight', 'Domains being crawled right now', label='engine')
+domains_crawled = metrics.counter(
+    'sitemap_domains_crawled_total', 'Finished domain crawls', label='outcome')
+
+def begin_immediate(cursor, db: str):
+    """BEGIN IMMEDIATE, recording how long SQLite's write lock kept us waiting"""
+    sqlite_lock_waiters.inc()
+    started = time.perf_counter()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+    finally:
+        sqlite_lock_waiters.dec()
+        sqlite_lock_wait_seconds.observe(time.perf_counter() - started, db)
+
+def track_domain(engine: str):
+    """Decorator keeping domains_in_flight and domains_crawled for a domain crawl function"""
+    def decorate(crawl):
+        if asyncio.iscoroutinefunction(crawl):
+            @functools.wraps(crawl)
+            async def wrapper(*args, **kwargs):
+                domains_in_flight.inc(label_value=engine)
+                try:
+                    result = await crawl(*args, **kwargs)
+                finally:
+                    domains_in_flight.dec(label_value=engine)
+                domains_crawled.inc(label_value=result.get("status", "failed"))
+                return result
+        else:
+            @functools.wraps(crawl)
+            def wrapper(*args, **kwargs):
+                domains_in_flight.inc(label_value=engine)
+                try:
+                    result = crawl(*args, **kwargs)
+                finally:
+                    domains_in_flight.dec(label_value=engine)
+                domains_crawled.inc(label_value=result.get("status", "failed"))
+                return result
+        return wrapper
+    return decorate
+
 # Enhanced History Manager
 class CrawlHistoryManager:
     def __init__(self, db_path='crawl_history.db'):
         self.db_path = db_path
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # Bumped after every committed change, so readers can tell cached results are stale
+        self.generation = 0
+        self._generation_lock = threading.Lock()
         self.init_database()
     
+    def bump_generation(self):
+        with self._generation_lock:
+            self.generation += 1
+    
+    def connect(self):
+        """Open a connection that waits on locks instead of failing"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        # Safe with WAL: only the last commits can be lost on power failure
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
     def init_database(self):
         """Initialize SQLite database for better performance"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
+        # Readers no longer block the writer (persistent per database)
+        cursor.execute('PRAGMA journal_mode=WAL')
+        
         # Main crawl sessions table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS crawl_sessions (
@@ -42,10 +320,21 @@ class CrawlHistoryManager:
                 sitemaps_found INTEGER DEFAULT 0,
                 error_message TEXT,
                 user_agent TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                started_at INTEGER
             )
         ''')
         
+        # Epoch column for range filters (DATE(timestamp) cannot use an index);
+        # older databases get it backfilled from their timestamp strings
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(crawl_sessions)')}
+        if 'started_at' not in columns:
+            cursor.execute('ALTER TABLE crawl_sessions ADD COLUMN started_at INTEGER')
+            cursor.execute(f"""
+                UPDATE crawl_sessions
+                SET started_at = CAST(strftime('%s', timestamp) AS INTEGER) - {HISTORY_UTC_OFFSET}
+            """)
+        
         # Detailed sitemap results table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sitemap_results (
@@ -87,10 +376,123 @@ class CrawlHistoryManager:
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_domain ON crawl_sessions(domain)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON crawl_sessions(timestamp)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_status ON crawl_sessions(status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_started_at ON crawl_sessions(started_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sitemap_results_session ON sitemap_results(session_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sample_urls_session ON sample_urls(session_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_performance_metrics_session ON performance_metrics(session_id)')
+        
+        # Full URL sets: each URL is stored once per domain with a dense
+        # per-domain ordinal, sessions keep a bitmap of the ordinals they saw
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS url_dictionary (
+                domain TEXT NOT NULL,
+                ordinal INTEGER NOT NULL,
+                url_hash INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                lastmod INTEGER,
+                changefreq INTEGER,
+                priority INTEGER,
+                PRIMARY KEY (domain, ordinal)
+            )
+        ''')
+        
+        # Sitemap metadata columns (latest crawl wins) for dictionaries created before them
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(url_dictionary)')}
+        for column in ('lastmod', 'changefreq', 'priority'):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE url_dictionary ADD COLUMN {column} INTEGER')
+        
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_url_dictionary_hash ON url_dictionary(domain, url_hash)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_url_dictionary_lastmod ON url_dictionary(domain, lastmod)')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS session_url_sets (
+                session_id INTEGER PRIMARY KEY,
+                domain TEXT NOT NULL,
+                url_count INTEGER NOT NULL,
+                bitmap BLOB NOT NULL,
+                FOREIGN KEY (session_id) REFERENCES crawl_sessions (id)
+            )
+        ''')
+        
+        # Statistics rollups, kept current by every saved session, so that
+        # get_statistics reads O(days) rows instead of scanning sessions
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_rollup (
+                day TEXT PRIMARY KEY,
+                crawls INTEGER NOT NULL DEFAULT 0,
+                successful INTEGER NOT NULL DEFAULT 0,
+                total_urls INTEGER NOT NULL DEFAULT 0,
+                total_duration REAL NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS domain_daily_rollup (
+                day TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                crawls INTEGER NOT NULL DEFAULT 0,
+                total_urls INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, domain)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS error_daily_rollup (
+                day TEXT NOT NULL,
+                error_message TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, error_message)
+            )
+        ''')
+        
+        # Backfill history saved before the rollups existed
+        has_rollups = cursor.execute('SELECT EXISTS (SELECT 1 FROM daily_rollup)').fetchone()[0]
+        has_sessions = cursor.execute('SELECT EXISTS (SELECT 1 FROM crawl_sessions)').fetchone()[0]
+        if has_sessions and not has_rollups:
+            self._rebuild_rollups(cursor)
         
         conn.commit()
         conn.close()
     
+    @staticmethod
+    def _rebuild_rollups(cursor):
+        """Recompute every rollup table from crawl_sessions"""
+        cursor.execute('DELETE FROM daily_rollup')
+        cursor.execute('DELETE FROM domain_daily_rollup')
+        cursor.execute('DELETE FROM error_daily_rollup')
+        cursor.execute('''
+            INSERT INTO daily_rollup (day, crawls, successful, total_urls, total_duration)
+            SELECT DATE(timestamp), COUNT(*),
+                   SUM(CASE WHEN status = 'success' THEN 1 ELSE 0 END),
+                   COALESCE(SUM(total_urls), 0), COALESCE(SUM(duration_sec), 0)
+            FROM crawl_sessions
+            WHERE DATE(timestamp) IS NOT NULL
+            GROUP BY DATE(timestamp)
+        ''')
+        cursor.execute('''
+            INSERT INTO domain_daily_rollup (day, domain, crawls, total_urls)
+            SELECT DATE(timestamp), domain, COUNT(*), COALESCE(SUM(total_urls), 0)
+            FROM crawl_sessions
+            WHERE DATE(timestamp) IS NOT NULL
+            GROUP BY DATE(timestamp), domain
+        ''')
+        cursor.execute('''
+            INSERT INTO error_daily_rollup (day, error_message, count)
+            SELECT DATE(timestamp), error_message, COUNT(*)
+            FROM crawl_sessions
+            WHERE status = 'failed' AND error_message IS NOT NULL AND DATE(timestamp) IS NOT NULL
+            GROUP BY DATE(timestamp), error_message
+        ''')
+    
+    def rebuild_rollups(self):
+        """Recompute the statistics rollups, e.g. after editing crawl_sessions by hand"""
+        conn = self.connect()
+        try:
+            self._rebuild_rollups(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+        self.bump_generation()
+    
     def migrate_from_json(self):
         """Migrate existing JSON history to SQLite"""
         if not os.path.exists(HISTORY_FILE):
@@ -130,76 +532,340 @@ class CrawlHistoryManager:
                           sitemaps_data: List[Dict] = None,
                           error_message: str = None,
                           sample_urls: List[str] = None,
-                          timestamp_override: str = None):
-        """Save enhanced crawl session"""
+                          timestamp_override: str = None,
+                          all_urls: Iterable[str] = None,
+                          metrics: List[tuple] = None):
+        """Save enhanced crawl session
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        The session is handed to the writer thread, which commits sessions
+        from concurrent crawls together; blocks until written and returns
+        the new session id (None on error). all_urls may also be a dict or
+        CrawlUrls carrying each URL's sitemap UrlMetadata. metrics are extra
+        (name, value, unit) performance metrics.
+        """
+        
+        if timestamp_override:
+            # For migration - use existing timestamp
+            timestamp = timestamp_override
+            started = parse_history_timestamp(timestamp_override)
+        else:
+            started = datetime.now(HISTORY_TZ)
+            timestamp = started.strftime('%Y-%m-%d %H:%M:%S')
+        
+        record = {
+            "domain": domain,
+            "timestamp": timestamp,
+            "started_at": int(started.timestamp()) if started else None,
+            "day": started.strftime('%Y-%m-%d') if started else None,
+            "status": status,
+            "total_urls": total_urls,
+            "duration": duration,
+            "sitemaps_data": sitemaps_data,
+            "error_message": error_message,
+            "sample_urls": sample_urls,
+            "all_urls": all_urls,
+            "metrics": metrics
+        }
+        
+        done = Future()
+        self._submit_write(record, done)
+        return done.result()
+    
+    def _submit_write(self, record: Dict, done: Future):
+        # Under the lock, so a writer that is shutting down cannot strand the record
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._writer_loop, daemon=True,
+                                                name='history-writer')
+                self._writer.start()
+            self._write_queue.put((record, done))
+    
+    def _writer_loop(self):
+        """Drain the write queue, one transaction per batch of pending sessions
         
+        If the writer fails, every session still waiting gets None (the
+        save error result) instead of blocking its caller; the next save
+        starts a new writer.
+        """
+        batch = []
         try:
-            tz = pytz.timezone("Asia/Ho_Chi_Minh")
-            if timestamp_override:
-                # For migration - use existing timestamp
-                timestamp = timestamp_override
-            else:
-                timestamp = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Insert main session
-            cursor.execute('''
-                INSERT INTO crawl_sessions 
-                (domain, timestamp, status, total_urls, duration_sec, 
-                 sitemaps_found, error_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                domain, timestamp, status, total_urls, duration,
-                len(sitemaps_data) if sitemaps_data else 0, error_message
-            ))
-            
-            session_id = cursor.lastrowid
-            
-            # Insert sitemap details
-            if sitemaps_data:
-                for sitemap in sitemaps_data:
-                    cursor.execute('''
-                        INSERT INTO sitemap_results 
-                        (session_id, sitemap_url, urls_found, processing_time, status, error_message)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (
-                        session_id,
-                        sitemap.get('sitemap', ''),
-                        sitemap.get('count', 0),
-                        sitemap.get('duration', 0),
-                        'success' if 'error' not in sitemap else 'failed',
-                        sitemap.get('error', None)
-                    ))
-            
-            # Store sample URLs (max 50 per session)
-            if sample_urls:
-                sample_urls_limited = sample_urls[:50]
-                for url in sample_urls_limited:
-                    # Detect URL type
-                    url_type = self.detect_url_type(url)
-                    cursor.execute('''
-                        INSERT INTO sample_urls (session_id, url, url_type)
-                        VALUES (?, ?, ?)
-                    ''', (session_id, url, url_type))
-            
-            # Store performance metrics
-            if duration > 0 and total_urls > 0:
-                urls_per_second = total_urls / duration
-                cursor.execute('''
-                    INSERT INTO performance_metrics 
-                    (session_id, metric_name, metric_value, metric_unit)
-                    VALUES (?, ?, ?, ?)
-                ''', (session_id, 'urls_per_second', urls_per_second, 'urls/sec'))
-            
-            conn.commit()
-            return session_id
+            self._write_loop(batch)
+        except Exception as e:
+            print(f"History writer stopped: {e}")
+        finally:
+            with self._writer_lock:
+                self._writer = None
+                while True:
+                    try:
+                        batch.append(self._write_queue.get_nowait())
+                    except queue.Empty:
+                        break
+            for _, done in batch:
+                if not done.done():
+                    done.set_result(None)
+    
+    def _write_loop(self, batch: List):
+        conn = self.connect()
+        conn.isolation_level = None  # explicit BEGIN/COMMIT below
+        conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS incoming_urls (
+                seq INTEGER PRIMARY KEY,
+                url_hash INTEGER NOT NULL UNIQUE,
+                url TEXT NOT NULL,
+                lastmod INTEGER,
+                changefreq INTEGER,
+                priority INTEGER
+            )
+        """)
+        
+        while True:
+            batch.clear()
+            batch.append(self._write_queue.get())
+            while len(batch) < HISTORY_WRITE_BATCH:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
             
+            session_ids = self._write_batch(conn, batch)
+            # Before waking the savers: a read after save_crawl_session returns sees the change
+            if any(session_id is not None for session_id in session_ids):
+                self.bump_generation()
+            for (_, done), session_id in zip(batch, session_ids):
+                done.set_result(session_id)
+    
+    def pending_writes(self) -> int:
+        """Sessions waiting for the writer thread"""
+        return self._write_queue.qsize()
+    
+    def _write_batch(self, conn, batch) -> List[Optional[int]]:
+        cursor = conn.cursor()
+        session_ids = []
+        started = time.perf_counter()
+        
+        try:
+            begin_immediate(cursor, 'history')
+            for record, _ in batch:
+                # A bad session must not take the rest of the batch with it
+                cursor.execute('SAVEPOINT save_session')
+                try:
+                    session_ids.append(self._insert_session(cursor, record))
+                    cursor.execute('RELEASE save_session')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO save_session')
+                    cursor.execute('RELEASE save_session')
+                    print(f"Error saving crawl session: {e}")
+                    session_ids.append(None)
+            cursor.execute('COMMIT')
+            db_write_seconds.observe(time.perf_counter() - started)
+            db_written_sessions.inc(len(session_ids) - session_ids.count(None))
+            return session_ids
+        
         except Exception as e:
-            conn.rollback()
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            db_write_seconds.observe(time.perf_counter() - started, 'error')
             print(f"Error saving crawl session: {e}")
+            return [None] * len(batch)
+    
+    def _insert_session(self, cursor, record: Dict) -> int:
+        sitemaps_data = record["sitemaps_data"]
+        sample_urls = record["sample_urls"]
+        duration = record["duration"]
+        total_urls = record["total_urls"]
+        
+        # Insert main session
+        cursor.execute('''
+            INSERT INTO crawl_sessions 
+            (domain, timestamp, status, total_urls, duration_sec, 
+             sitemaps_found, error_message, started_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            record["domain"], record["timestamp"], record["status"], total_urls, duration,
+            len(sitemaps_data) if sitemaps_data else 0, record["error_message"],
+            record["started_at"]
+        ))
+        
+        session_id = cursor.lastrowid
+        
+        if record["day"]:
+            self._update_rollups(cursor, record)
+        
+        # Insert sitemap details
+        if sitemaps_data:
+            cursor.executemany('''
+                INSERT INTO sitemap_results 
+                (session_id, sitemap_url, urls_found, processing_time, status, error_message)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (
+                    session_id,
+                    sitemap.get('sitemap', ''),
+                    sitemap.get('count', 0),
+                    sitemap.get('duration', 0),
+                    'success' if 'error' not in sitemap else 'failed',
+                    sitemap.get('error', None)
+                ) for sitemap in sitemaps_data
+            ])
+        
+        # Store sample URLs (max 50 per session)
+        if sample_urls:
+            cursor.executemany('''
+                INSERT INTO sample_urls (session_id, url, url_type)
+                VALUES (?, ?, ?)
+            ''', [(session_id, url, self.detect_url_type(url)) for url in sample_urls[:50]])
+        
+        # Store performance metrics
+        metrics = list(record["metrics"] or [])
+        if duration > 0 and total_urls > 0:
+            metrics.insert(0, ('urls_per_second', total_urls / duration, 'urls/sec'))
+        if metrics:
+            cursor.executemany('''
+                INSERT INTO performance_metrics 
+                (session_id, metric_name, metric_value, metric_unit)
+                VALUES (?, ?, ?, ?)
+            ''', [(session_id, name, value, unit) for name, value, unit in metrics])
+        
+        # Store the full URL set
+        if record["all_urls"]:
+            self._store_url_set(cursor, session_id, record["domain"], record["all_urls"])
+        
+        return session_id
+    
+    @staticmethod
+    def _update_rollups(cursor, record: Dict):
+        """Add one session to the statistics rollups of its day"""
+        day = record["day"]
+        total_urls = record["total_urls"] or 0
+        cursor.execute('''
+            INSERT INTO daily_rollup (day, crawls, successful, total_urls, total_duration)
+            VALUES (?, 1, ?, ?, ?)
+            ON CONFLICT (day) DO UPDATE SET
+                crawls = crawls + 1,
+                successful = successful + excluded.successful,
+                total_urls = total_urls + excluded.total_urls,
+                total_duration = total_duration + excluded.total_duration
+        ''', (day, 1 if record["status"] == 'success' else 0, total_urls, record["duration"] or 0))
+        cursor.execute('''
+            INSERT INTO domain_daily_rollup (day, domain, crawls, total_urls)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT (day, domain) DO UPDATE SET
+                crawls = crawls + 1,
+                total_urls = total_urls + excluded.total_urls
+        ''', (day, record["domain"], total_urls))
+        if record["status"] == 'failed' and record["error_message"] is not None:
+            cursor.execute('''
+                INSERT INTO error_daily_rollup (day, error_message, count)
+                VALUES (?, ?, 1)
+                ON CONFLICT (day, error_message) DO UPDATE SET count = count + 1
+            ''', (day, record["error_message"]))
+    
+    def _store_url_set(self, cursor, session_id: int, domain: str, urls) -> int:
+        """Intern the session's URLs into the domain dictionary and save its bitmap"""
+        
+        # dicts and CrawlUrls carry each URL's sitemap metadata
+        has_metadata = hasattr(urls, 'items')
+        pairs = urls.items() if has_metadata else ((url, None) for url in urls)
+        
+        def incoming_rows():
+            for url, meta in pairs:
+                yield (url_fingerprint(url), url,
+                       *(meta.as_row() if meta is not None else (None, None, None)))
+        
+        cursor.execute('DELETE FROM temp.incoming_urls')
+        cursor.executemany('''
+            INSERT OR IGNORE INTO temp.incoming_urls (url_hash, url, lastmod, changefreq, priority)
+            VALUES (?, ?, ?, ?, ?)
+        ''', incoming_rows())
+        
+        # New URLs get the next free ordinals of this domain
+        cursor.execute('SELECT COALESCE(MAX(ordinal) + 1, 0) FROM url_dictionary WHERE domain = ?',
+                       (domain,))
+        next_ordinal = cursor.fetchone()[0]
+        cursor.execute('''
+            INSERT INTO url_dictionary (domain, ordinal, url_hash, url, lastmod, changefreq, priority)
+            SELECT ?, ? + ROW_NUMBER() OVER (ORDER BY i.seq) - 1, i.url_hash, i.url,
+                   i.lastmod, i.changefreq, i.priority
+            FROM temp.incoming_urls i
+            WHERE NOT EXISTS (
+                SELECT 1 FROM url_dictionary d WHERE d.domain = ? AND d.url_hash = i.url_hash
+            )
+        ''', (domain, next_ordinal, domain))
+        
+        # Known URLs take this crawl's sitemap metadata; unchanged rows are not rewritten
+        if has_metadata:
+            cursor.execute('''
+                UPDATE url_dictionary AS d
+                SET lastmod = i.lastmod, changefreq = i.changefreq, priority = i.priority
+                FROM temp.incoming_urls i
+                WHERE d.domain = ? AND d.url_hash = i.url_hash
+                  AND (d.lastmod IS NOT i.lastmod OR d.changefreq IS NOT i.changefreq
+                       OR d.priority IS NOT i.priority)
+            ''', (domain,))
+        
+        cursor.execute('''
+            SELECT d.ordinal FROM temp.incoming_urls i
+            JOIN url_dictionary d ON d.domain = ? AND d.url_hash = i.url_hash
+        ''', (domain,))
+        ordinals = [row[0] for row in cursor.fetchall()]
+        cursor.execute('DELETE FROM temp.incoming_urls')
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO session_url_sets (session_id, domain, url_count, bitmap)
+            VALUES (?, ?, ?, ?)
+        ''', (session_id, domain, len(ordinals), encode_url_bitmap(ordinals)))
+        return len(ordinals)
+    
+    def get_session_url_set(self, session_id: int) -> Optional[Dict]:
+        """Domain, URL count and decoded membership bitmap of a stored session"""
+        conn = self.connect()
+        try:
+            row = conn.execute('''
+                SELECT domain, url_count, bitmap FROM session_url_sets WHERE session_id = ?
+            ''', (session_id,)).fetchone()
+        finally:
+            conn.close()
+        
+        if not row:
             return None
+        return {"domain": row[0], "url_count": row[1], "bitmap": zlib.decompress(row[2])}
+    
+    def iter_session_urls(self, session_id: int, batch_size: int = EXPORT_BATCH_SIZE,
+                          with_metadata: bool = False, modified_since: int = None):
+        """Yield every URL stored for a session, in first-seen order
+        
+        with_metadata yields (url, lastmod, changefreq, priority) rows with
+        the sitemap metadata of the domain's latest crawl instead. A
+        modified_since epoch keeps only URLs whose lastmod is at least that.
+        """
+        url_set = self.get_session_url_set(session_id)
+        if url_set is None:
+            return
+        
+        bitmap = url_set["bitmap"]
+        max_ordinal = len(bitmap) * 8
+        
+        query = '''
+            SELECT ordinal, url, lastmod, changefreq, priority FROM url_dictionary
+            WHERE domain = ? AND ordinal < ?
+        '''
+        params = [url_set["domain"], max_ordinal]
+        if modified_since is not None:
+            query += ' AND lastmod >= ?'
+            params.append(modified_since)
+        query += ' ORDER BY ordinal'
+        
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for ordinal, url, lastmod, changefreq, priority in rows:
+                    if bitmap[ordinal >> 3] >> (ordinal & 7) & 1:
+                        yield (url, lastmod, changefreq, priority) if with_metadata else url
         finally:
             conn.close()
     
@@ -222,31 +888,22 @@ class CrawlHistoryManager:
     
     def get_history(self, limit: int = 20, offset: int = 0, 
                    domain_filter: str = None, status_filter: str = None,
-                   date_from: str = None, date_to: str = None) -> Dict:
-        """Get crawl history with advanced filtering"""
+                   date_from: str = None, date_to: str = None,
+                   cursor_token: str = None) -> Dict:
+        """Get crawl history with advanced filtering
+        
+        Pass the previous page's next_cursor as cursor_token for keyset
+        pagination, which stays fast however deep the page; offset is
+        ignored in that case.
+        """
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
         # Build dynamic query
-        where_conditions = []
-        params = []
-        
-        if domain_filter:
-            where_conditions.append("domain LIKE ?")
-            params.append(f"%{domain_filter}%")
-        
-        if status_filter:
-            where_conditions.append("status = ?")
-            params.append(status_filter)
-        
-        if date_from:
-            where_conditions.append("DATE(timestamp) >= ?")
-            params.append(date_from)
-        
-        if date_to:
-            where_conditions.append("DATE(timestamp) <= ?")
-            params.append(date_to)
+        where_conditions, params = self._filter_conditions(
+            domain_filter, status_filter, date_from, date_to
+        )
         
         where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
         
@@ -255,37 +912,63 @@ class CrawlHistoryManager:
         cursor.execute(count_query, params)
         total_count = cursor.fetchone()[0]
         
+        # Keyset condition: strictly after the last (timestamp, id) served
+        page_conditions = list(where_conditions)
+        page_params = list(params)
+        if cursor_token:
+            after_timestamp, after_id = self.decode_cursor(cursor_token)
+            page_conditions.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            page_params.extend([after_timestamp, after_timestamp, after_id])
+            offset = 0
+        page_where = "WHERE " + " AND ".join(page_conditions) if page_conditions else ""
+        
         # Get paginated results
         main_query = f'''
             SELECT id, domain, timestamp, status, total_urls, duration_sec, 
                    sitemaps_found, error_message
             FROM crawl_sessions 
-            {where_clause}
-            ORDER BY timestamp DESC 
+            {page_where}
+            ORDER BY timestamp DESC, id DESC 
             LIMIT ? OFFSET ?
         '''
         
-        cursor.execute(main_query, params + [limit, offset])
+        cursor.execute(main_query, page_params + [limit, offset])
         sessions = cursor.fetchall()
         
+        # Child rows for the whole page in a few IN (...) queries, not 2 per session
+        session_ids = [session[0] for session in sessions]
+        sitemaps_by_session = defaultdict(list)
+        samples_by_session = defaultdict(list)
+        
+        for start in range(0, len(session_ids), HISTORY_IN_CHUNK):
+            chunk = session_ids[start:start + HISTORY_IN_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            
+            cursor.execute(f'''
+                SELECT session_id, sitemap_url, urls_found, processing_time, status, error_message
+                FROM sitemap_results WHERE session_id IN ({placeholders})
+                ORDER BY id
+            ''', chunk)
+            for row in cursor.fetchall():
+                sitemaps_by_session[row[0]].append(row[1:])
+            
+            # First 10 sample URLs per session
+            cursor.execute(f'''
+                SELECT session_id, url, url_type FROM (
+                    SELECT session_id, url, url_type,
+                           ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY id) AS rn
+                    FROM sample_urls WHERE session_id IN ({placeholders})
+                ) WHERE rn <= 10
+            ''', chunk)
+            for row in cursor.fetchall():
+                samples_by_session[row[0]].append(row[1:])
+        
         # Format results
         results = []
         for session in sessions:
             session_id, domain, timestamp, status, total_urls, duration, sitemaps_found, error_msg = session
-            
-            # Get sitemap details for this session
-            cursor.execute('''
-                SELECT sitemap_url, urls_found, processing_time, status, error_message
-                FROM sitemap_results WHERE session_id = ?
-            ''', (session_id,))
-            sitemaps = cursor.fetchall()
-            
-            # Get sample URLs
-            cursor.execute('''
-                SELECT url, url_type FROM sample_urls 
-                WHERE session_id = ? LIMIT 10
-            ''', (session_id,))
-            sample_urls = cursor.fetchall()
+            sitemaps = sitemaps_by_session[session_id]
+            sample_urls = samples_by_session[session_id]
             
             results.append({
                 "id": session_id,
@@ -312,11 +995,17 @@ class CrawlHistoryManager:
         
         conn.close()
         
+        next_cursor = None
+        if len(sessions) == limit:
+            last = sessions[-1]
+            next_cursor = self.encode_cursor(last[2], last[0])
+        
         return {
             "results": results,
             "total": total_count,
             "limit": limit,
             "offset": offset,
+            "next_cursor": next_cursor,
             "filters_applied": {
                 "domain": domain_filter,
                 "status": status_filter,
@@ -325,43 +1014,116 @@ class CrawlHistoryManager:
             }
         }
     
+    @staticmethod
+    def _filter_conditions(domain_filter: str = None, status_filter: str = None,
+                           date_from: str = None, date_to: str = None):
+        """WHERE conditions and params shared by history queries"""
+        where_conditions = []
+        params = []
+        
+        if domain_filter:
+            where_conditions.append("domain LIKE ?")
+            params.append(f"%{domain_filter}%")
+        
+        if status_filter:
+            where_conditions.append("status = ?")
+            params.append(status_filter)
+        
+        # Whole local days as an epoch range, so idx_started_at applies
+        if date_from:
+            where_conditions.append("started_at >= ?")
+            params.append(history_day_start(date_from))
+        
+        if date_to:
+            where_conditions.append("started_at < ?")
+            params.append(history_day_start(date_to) + 86400)
+        
+        return where_conditions, params
+    
+    def iter_sessions(self, domain_filter: str = None, status_filter: str = None,
+                      date_from: str = None, date_to: str = None,
+                      batch_size: int = EXPORT_BATCH_SIZE):
+        """Yield matching sessions newest first, batch_size rows at a time"""
+        
+        where_conditions, params = self._filter_conditions(
+            domain_filter, status_filter, date_from, date_to
+        )
+        where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
+        
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, domain, timestamp, status, total_urls, duration_sec,
+                       sitemaps_found, error_message
+                FROM crawl_sessions
+                {where_clause}
+                ORDER BY timestamp DESC, id DESC
+            ''', params)
+            
+            columns = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def encode_cursor(timestamp: str, session_id: int) -> str:
+        return f"{timestamp}|{session_id}"
+    
+    @staticmethod
+    def decode_cursor(cursor_token: str):
+        try:
+            timestamp, session_id = cursor_token.rsplit('|', 1)
+            return timestamp, int(session_id)
+        except ValueError:
+            raise ValueError(f"Cursor không hợp lệ: {cursor_token}")
+    
     def get_statistics(self, days: int = 30) -> Dict:
-        """Get comprehensive statistics"""
+        """Get comprehensive statistics
+        
+        Read from the daily rollup tables, so the cost grows with the number
+        of days (and domains per day) rather than the number of sessions.
+        """
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
-        date_limit = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        date_limit = (datetime.now(HISTORY_TZ) - timedelta(days=days)).strftime('%Y-%m-%d')
         
         stats = {}
         
         # Basic counts
         cursor.execute('''
             SELECT 
-                COUNT(*) as total_crawls,
-                SUM(CASE WHEN status = 'success' THEN 1 ELSE 0 END) as successful_crawls,
+                SUM(crawls) as total_crawls,
+                SUM(successful) as successful_crawls,
                 SUM(total_urls) as total_urls_found,
-                AVG(duration_sec) as avg_duration,
-                AVG(total_urls) as avg_urls_per_crawl
-            FROM crawl_sessions 
-            WHERE DATE(timestamp) >= ?
+                SUM(total_duration) as total_duration
+            FROM daily_rollup 
+            WHERE day >= ?
         ''', (date_limit,))
         
-        basic_stats = cursor.fetchone()
+        total_crawls, successful_crawls, total_urls_found, total_duration = cursor.fetchone()
+        total_crawls = total_crawls or 0
         stats['basic'] = {
-            "total_crawls": basic_stats[0] or 0,
-            "successful_crawls": basic_stats[1] or 0,
-            "success_rate": round((basic_stats[1] / basic_stats[0] * 100) if basic_stats[0] > 0 else 0, 1),
-            "total_urls_found": basic_stats[2] or 0,
-            "avg_duration": round(basic_stats[3] or 0, 2),
-            "avg_urls_per_crawl": round(basic_stats[4] or 0, 1)
+            "total_crawls": total_crawls,
+            "successful_crawls": successful_crawls or 0,
+            "success_rate": round((successful_crawls / total_crawls * 100) if total_crawls > 0 else 0, 1),
+            "total_urls_found": total_urls_found or 0,
+            "avg_duration": round(total_duration / total_crawls if total_crawls else 0, 2),
+            "avg_urls_per_crawl": round(total_urls_found / total_crawls if total_crawls else 0, 1)
         }
         
         # Top domains
         cursor.execute('''
-            SELECT domain, COUNT(*) as crawl_count, SUM(total_urls) as total_urls
-            FROM crawl_sessions 
-            WHERE DATE(timestamp) >= ?
+            SELECT domain, SUM(crawls) as crawl_count, SUM(total_urls) as total_urls
+            FROM domain_daily_rollup 
+            WHERE day >= ?
             GROUP BY domain 
             ORDER BY crawl_count DESC 
             LIMIT 10
@@ -374,13 +1136,10 @@ class CrawlHistoryManager:
         
         # Daily activity
         cursor.execute('''
-            SELECT DATE(timestamp) as date, 
-                   COUNT(*) as crawls,
-                   SUM(total_urls) as urls_found
-            FROM crawl_sessions 
-            WHERE DATE(timestamp) >= ?
-            GROUP BY DATE(timestamp)
-            ORDER BY date DESC
+            SELECT day as date, crawls, total_urls as urls_found
+            FROM daily_rollup 
+            WHERE day >= ?
+            ORDER BY day DESC
             LIMIT 30
         ''', (date_limit,))
         
@@ -391,9 +1150,9 @@ class CrawlHistoryManager:
         
         # Error analysis
         cursor.execute('''
-            SELECT error_message, COUNT(*) as count
-            FROM crawl_sessions 
-            WHERE status = 'failed' AND DATE(timestamp) >= ? AND error_message IS NOT NULL
+            SELECT error_message, SUM(count) as count
+            FROM error_daily_rollup 
+            WHERE day >= ?
             GROUP BY error_message
             ORDER BY count DESC
             LIMIT 10
@@ -410,14 +1169,14 @@ class CrawlHistoryManager:
     def compare_crawls(self, domain: str, limit: int = 5) -> Dict:
         """Compare recent crawls for a domain"""
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT timestamp, total_urls, duration_sec, status
+            SELECT timestamp, total_urls, duration_sec, status, id
             FROM crawl_sessions 
             WHERE domain = ? 
-            ORDER BY timestamp DESC 
+            ORDER BY timestamp DESC, id DESC 
             LIMIT ?
         ''', (domain, limit))
         
@@ -438,7 +1197,8 @@ class CrawlHistoryManager:
                 "timestamp": crawl[0],
                 "total_urls": crawl[1] or 0,
                 "duration": crawl[2] or 0,
-                "status": crawl[3]
+                "status": crawl[3],
+                "session_id": crawl[4]
             })
         
         # Calculate trends
@@ -455,215 +1215,3420 @@ class CrawlHistoryManager:
                 "duration_change": round(duration_change, 2),
                 "duration_change_percent": round((duration_change / previous[2] * 100) if previous[2] and previous[2] > 0 else 0, 1)
             }
+            
+            # Exact URL churn when both crawls stored their URL sets
+            diff = self.diff_sessions(previous[4], latest[4])
+            if diff:
+                comparison["trends"]["urls_added"] = diff["added"]
+                comparison["trends"]["urls_removed"] = diff["removed"]
         
         return comparison
+    
+    def latest_url_set_sessions(self, domain: str, limit: int = 2) -> List[int]:
+        """Ids of the newest sessions of a domain that have a stored URL set"""
+        conn = self.connect()
+        try:
+            rows = conn.execute('''
+                SELECT session_id FROM session_url_sets
+                WHERE domain = ?
+                ORDER BY session_id DESC
+                LIMIT ?
+            ''', (domain, limit)).fetchall()
+        finally:
+            conn.close()
+        return [row[0] for row in rows]
+    
+    def diff_sessions(self, old_session_id: int, new_session_id: int) -> Optional[Dict]:
+        """Added/removed/unchanged URLs between two sessions of one domain
+        
+        Both bitmaps index the same per-domain ordinals, so the set algebra
+        is a handful of big-integer AND/NOT operations; no URL strings are
+        loaded. Returns None when either session has no stored URL set.
+        """
+        old_set = self.get_session_url_set(old_session_id)
+        new_set = self.get_session_url_set(new_session_id)
+        if old_set is None or new_set is None:
+            return None
+        if old_set["domain"] != new_set["domain"]:
+            raise ValueError("Hai phiên crawl không cùng domain")
+        
+        old_bits = int.from_bytes(old_set["bitmap"], 'little')
+        new_bits = int.from_bytes(new_set["bitmap"], 'little')
+        added = new_bits & ~old_bits
+        removed = old_bits & ~new_bits
+        
+        return {
+            "domain": new_set["domain"],
+            "from_session": old_session_id,
+            "to_session": new_session_id,
+            "added": added.bit_count(),
+            "removed": removed.bit_count(),
+            "unchanged": (old_bits & new_bits).bit_count(),
+            "added_bits": added,
+            "removed_bits": removed
+        }
+    
+    def iter_url_changes(self, diff: Dict, change: str = 'all',
+                         batch_size: int = HISTORY_IN_CHUNK):
+        """Yield ('added'|'removed', url) for a diff_sessions result"""
+        added = diff["added_bits"] if change in ('all', 'added') else 0
+        removed = diff["removed_bits"] if change in ('all', 'removed') else 0
+        changed = added | removed
+        if not changed:
+            return
+        
+        changed_bytes = changed.to_bytes((changed.bit_length() + 7) // 8, 'little')
+        added_bytes = added.to_bytes(len(changed_bytes), 'little')
+        ordinals = iter_bitmap_ordinals(changed_bytes)
+        
+        # Only the changed ordinals are looked up, by primary key
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            while True:
+                chunk = list(itertools.islice(ordinals, batch_size))
+                if not chunk:
+                    break
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(f'''
+                    SELECT ordinal, url FROM url_dictionary
+                    WHERE domain = ? AND ordinal IN ({placeholders})
+                    ORDER BY ordinal
+                ''', [diff["domain"]] + chunk)
+                for ordinal, url in cursor.fetchall():
+                    is_added = added_bytes[ordinal >> 3] >> (ordinal & 7) & 1
+                    yield ('added' if is_added else 'removed'), url
+        finally:
+            conn.close()
 
-# Initialize global history manager and migrate existing data
-history_manager = CrawlHistoryManager()
-history_manager.migrate_from_json()
+# Compact (link, extra) entry buffers, shared by the validator cache and parse workers
+def _pack_entry_lines(entries: List, fields) -> bytes:
+    """One line per (link, extra) entry, extra fields tab-separated after the link"""
+    lines = []
+    for link, extra in entries:
+        values = fields(extra) if extra is not None else ()
+        if any(value is not None for value in values):
+            link += ''.join('\t' + ('' if value is None else str(value)) for value in values)
+        lines.append(link)
+    return '\n'.join(lines).encode('utf-8')
 
-# Legacy functions (keep for backward compatibility)
-def fetch_url(url):
-    headers = {
-        'User-Agent': (
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
-            '(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36'
-        ),
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9',
-        'Accept-Language': 'en-US,en;q=0.9',
-    }
-    try:
-        res = requests.get(url, headers=headers, timeout=10)
-        res.raise_for_status()
-        return res.text
-    except requests.exceptions.HTTPError as e:
-        if res.status_code == 403:
-            raise Exception(f"403 Forbidden – Trang từ chối truy cập: {url}")
-        raise Exception(f"Lỗi HTTP {res.status_code} – {url}")
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+def _unpack_entry_lines(data: bytes):
+    text = data.decode('utf-8')
+    for line in (text.split('\n') if text else []):
+        link, *values = line.split('\t')
+        yield link, [int(value) if value else None for value in values]
 
-def is_valid_xml(text):
+def pack_url_entries(urls: List) -> bytes:
+    return _pack_entry_lines(urls, UrlMetadata.as_row)
+
+def unpack_url_entries(data: bytes) -> List:
+    return [(link, UrlMetadata(*values) if values else None)
+            for link, values in _unpack_entry_lines(data)]
+
+def pack_nested_entries(nested: List) -> bytes:
+    return _pack_entry_lines(nested, lambda lastmod: (lastmod,))
+
+def unpack_nested_entries(data: bytes) -> List:
+    return [(link, values[0] if values else None) for link, values in _unpack_entry_lines(data)]
+
+# HTTP validator cache for conditional re-crawls
+VALIDATOR_CACHE_MAX_AGE_DAYS = 30
+VALIDATOR_CHUNK_ENTRIES = 5000       # URL entries per stored chunk of a sitemap
+VALIDATOR_ORPHAN_AGE = 24 * 3600     # seconds before chunks of an unfinished download are dropped
+
+class ValidatorCacheWriter:
+    """One sitemap's entries, written to the validator cache as they stream
+    
+    URL entries are stored in chunks under a new generation while the
+    body downloads, so memory holds one chunk instead of a second copy
+    of the whole sitemap. commit() then points the sitemap's row at that
+    generation and drops the previous one; abort() drops the chunks of
+    a download that did not finish.
+    """
+    
+    def __init__(self, cache: 'SitemapValidatorCache', url: str):
+        self.cache = cache
+        self.url = url
+        self.generation = time.time_ns()
+        self.urls = []
+        self.nested = []
+        self.chunks = 0
+        self.failed = False
+    
+    def add(self, kind: str, link: str, extra):
+        (self.urls if kind == 'url' else self.nested).append((link, extra))
+    
+    @property
+    def full(self) -> bool:
+        return len(self.urls) >= VALIDATOR_CHUNK_ENTRIES
+    
+    def flush(self):
+        """Store the buffered URL entries as the next chunk"""
+        urls, self.urls = self.urls, []
+        if urls and not self.failed:
+            self.failed = not self.cache.store_chunk(self.url, self.generation, self.chunks, urls)
+            self.chunks += 1
+    
+    def commit(self, etag: str, last_modified: str, bytes_downloaded: int = 0,
+               index_lastmod: int = None):
+        self.flush()
+        if self.failed:
+            self.abort()
+            return
+        self.cache.commit_generation(self.url, self.generation, self.chunks, etag, last_modified,
+                                     self.nested, bytes_downloaded, index_lastmod)
+    
+    def abort(self):
+        self.urls = []
+        if self.chunks:
+            self.cache.drop_generation(self.url, self.generation)
+
+class SitemapValidatorCache:
+    """ETag/Last-Modified and index <lastmod> per sitemap URL plus the entries it contained"""
+    
+    def __init__(self, db_path='crawl_history.db', max_age_days: int = VALIDATOR_CACHE_MAX_AGE_DAYS):
+        self.db_path = db_path
+        self.max_age_days = max_age_days
+        self.init_database()
+    
+    def init_database(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        cursor = conn.cursor()
+        
+        # Entries are zlib-compressed, newline-joined URL lists; index_lastmod
+        # is the parent index's <lastmod> for the sitemap at download time.
+        # URL entries live in sitemap_validator_chunks under the row's
+        # generation; urls_blob only holds those of rows stored whole.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sitemap_validators (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                urls_blob BLOB,
+                nested_blob BLOB,
+                bytes_downloaded INTEGER DEFAULT 0,
+                updated_at REAL NOT NULL,
+                index_lastmod INTEGER,
+                generation INTEGER
+            )
+        ''')
+        
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(sitemap_validators)')}
+        if 'index_lastmod' not in columns:
+            cursor.execute('ALTER TABLE sitemap_validators ADD COLUMN index_lastmod INTEGER')
+        if 'generation' not in columns:
+            cursor.execute('ALTER TABLE sitemap_validators ADD COLUMN generation INTEGER')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sitemap_validator_chunks (
+                url TEXT NOT NULL,
+                generation INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                urls_blob BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (url, generation, seq)
+            )
+        ''')
+        
+        # Forget sitemaps we have not seen for a while, and chunks no row
+        # points to that are too old to belong to a download in progress
+        cutoff = time.time() - self.max_age_days * 86400
+        cursor.execute('DELETE FROM sitemap_validators WHERE updated_at < ?', (cutoff,))
+        cursor.execute('''
+            DELETE FROM sitemap_validator_chunks
+            WHERE created_at < ? AND NOT EXISTS (
+                SELECT 1 FROM sitemap_validators v
+                WHERE v.url = sitemap_validator_chunks.url
+                  AND v.generation = sitemap_validator_chunks.generation
+            )
+        ''', (time.time() - VALIDATOR_ORPHAN_AGE,))
+        
+        conn.commit()
+        conn.close()
+    
+    @staticmethod
+    def _pack_urls(urls: List) -> bytes:
+        return zlib.compress(pack_url_entries(urls))
+    
+    @staticmethod
+    def _unpack_urls(blob: bytes) -> List:
+        return unpack_url_entries(zlib.decompress(blob) if blob else b'')
+    
+    @staticmethod
+    def _pack_nested(nested: List) -> bytes:
+        return zlib.compress(pack_nested_entries(nested))
+    
+    @staticmethod
+    def _unpack_nested(blob: bytes) -> List:
+        return unpack_nested_entries(zlib.decompress(blob) if blob else b'')
+    
+    def get_validators(self, url: str) -> Optional[Dict]:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            row = conn.execute('''
+                SELECT etag, last_modified, bytes_downloaded
+                FROM sitemap_validators WHERE url = ?
+            ''', (url,)).fetchone()
+        finally:
+            conn.close()
+        
+        if not row:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "bytes_downloaded": row[2] or 0}
+    
+    def load_entries(self, url: str, index_lastmod: int = None):
+        """Return the (urls, nested) stored for url, or None
+        
+        A known index_lastmod is recorded with the entries, so a 304 still
+        lets the next crawl skip the sitemap on its index <lastmod>.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            stored = self._select_entries(conn, 'v.url = ?', (url,))
+            if stored:
+                conn.execute('''
+                    UPDATE sitemap_validators
+                    SET updated_at = ?, index_lastmod = COALESCE(?, index_lastmod)
+                    WHERE url = ?
+                ''', (time.time(), index_lastmod, url))
+                conn.commit()
+        finally:
+            conn.close()
+        
+        if not stored:
+            return None
+        return stored["urls"], stored["nested"]
+    
+    def load_unchanged(self, url: str, index_lastmod: int) -> Optional[Dict]:
+        """Entries of url if they were stored under the same index <lastmod>, else None"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            stored = self._select_entries(conn, 'v.url = ? AND v.index_lastmod = ?',
+                                          (url, index_lastmod))
+            if stored:
+                conn.execute('UPDATE sitemap_validators SET updated_at = ? WHERE url = ?',
+                             (time.time(), url))
+                conn.commit()
+        finally:
+            conn.close()
+        return stored
+    
+    def _select_entries(self, conn, where: str, params) -> Optional[Dict]:
+        """{"urls", "nested", "bytes_downloaded"} of the row matching where, or None
+        
+        One statement, so a concurrent commit cannot swap the generation
+        between reading the row and reading its chunks.
+        """
+        rows = conn.execute(f'''
+            SELECT v.urls_blob, v.nested_blob, v.bytes_downloaded, c.urls_blob
+            FROM sitemap_validators v
+            LEFT JOIN sitemap_validator_chunks c
+                ON c.url = v.url AND c.generation = v.generation
+            WHERE {where}
+            ORDER BY c.seq
+        ''', params).fetchall()
+        if not rows:
+            return None
+        
+        urls = self._unpack_urls(rows[0][0])
+        for row in rows:
+            if row[3] is not None:
+                urls.extend(self._unpack_urls(row[3]))
+        return {
+            "urls": urls,
+            "nested": self._unpack_nested(rows[0][1]),
+            "bytes_downloaded": rows[0][2] or 0
+        }
+    
+    def writer(self, url: str) -> ValidatorCacheWriter:
+        return ValidatorCacheWriter(self, url)
+    
+    def store(self, url: str, etag: str, last_modified: str, urls: List, nested: List,
+              bytes_downloaded: int = 0, index_lastmod: int = None):
+        """Store entries already held as complete lists"""
+        writer = self.writer(url)
+        for kind, entries in (('url', urls), ('sitemap', nested)):
+            for link, extra in entries:
+                writer.add(kind, link, extra)
+                if writer.full:
+                    writer.flush()
+        writer.commit(etag, last_modified, bytes_downloaded, index_lastmod)
+    
+    def store_chunk(self, url: str, generation: int, seq: int, urls: List) -> bool:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute('''
+                INSERT INTO sitemap_validator_chunks (url, generation, seq, urls_blob, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (url, generation, seq, self._pack_urls(urls), time.time()))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Warning: Could not cache validators for {url}: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    def commit_generation(self, url: str, generation: int, chunks: int, etag: str,
+                          last_modified: str, nested: List, bytes_downloaded: int = 0,
+                          index_lastmod: int = None):
+        """Point url's row at a fully stored generation and drop the previous one
+        
+        If a concurrent download of the same sitemap committed first, it
+        dropped some of our chunks; that download's entries are kept.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.isolation_level = None
+        try:
+            begin_immediate(conn, 'validators')
+            stored = conn.execute('''
+                SELECT COUNT(*) FROM sitemap_validator_chunks WHERE url = ? AND generation = ?
+            ''', (url, generation)).fetchone()[0]
+            if stored == chunks:
+                conn.execute('''
+                    INSERT OR REPLACE INTO sitemap_validators
+                    (url, etag, last_modified, urls_blob, nested_blob, bytes_downloaded,
+                     updated_at, index_lastmod, generation)
+                    VALUES (?, ?, ?, NULL, ?, ?, ?, ?, ?)
+                ''', (
+                    url, etag, last_modified, self._pack_nested(nested),
+                    bytes_downloaded, time.time(), index_lastmod, generation
+                ))
+                conn.execute('''
+                    DELETE FROM sitemap_validator_chunks WHERE url = ? AND generation != ?
+                ''', (url, generation))
+            else:
+                conn.execute('''
+                    DELETE FROM sitemap_validator_chunks WHERE url = ? AND generation = ?
+                ''', (url, generation))
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            print(f"Warning: Could not cache validators for {url}: {e}")
+        finally:
+            conn.close()
+    
+    def drop_generation(self, url: str, generation: int):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute('''
+                DELETE FROM sitemap_validator_chunks WHERE url = ? AND generation = ?
+            ''', (url, generation))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Warning: Could not cache validators for {url}: {e}")
+        finally:
+            conn.close()
+
+# Sitemap discovery cache
+DISCOVERY_CACHE_TTL = 6 * 3600          # seconds a discovery result is reused as-is
+DISCOVERY_CACHE_MAX_ENTRIES = 10_000    # LRU bound, in memory and in the database
+DISCOVERY_SCHEMES = ('https', 'http')
+
+class DiscoveryCache:
+    """Sitemaps found per domain, the (scheme, host) variant that worked and its Crawl-delay
+    
+    Fresh entries skip discovery entirely; stale ones still tell
+    discover_sitemaps which variant to try first. Entries are kept in an
+    in-memory LRU backed by the discovery_cache table.
+    """
+    
+    def __init__(self, db_path='crawl_history.db', ttl: float = DISCOVERY_CACHE_TTL,
+                 max_entries: int = DISCOVERY_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.init_database()
+    
+    def init_database(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        cursor = conn.cursor()
+        
+        # sitemaps is a newline-joined URL list
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS discovery_cache (
+                domain TEXT PRIMARY KEY,
+                scheme TEXT NOT NULL,
+                host TEXT NOT NULL,
+                sitemaps TEXT NOT NULL,
+                discovered_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                crawl_delay REAL
+            )
+        ''')
+        
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(discovery_cache)')}
+        if 'crawl_delay' not in columns:
+            cursor.execute('ALTER TABLE discovery_cache ADD COLUMN crawl_delay REAL')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_discovery_cache_last_used ON discovery_cache(last_used)')
+        
+        conn.commit()
+        conn.close()
+    
+    def _remember(self, domain: str, entry: Dict):
+        """Add to the in-memory LRU; the caller holds the lock"""
+        self._entries[domain] = entry
+        self._entries.move_to_end(domain)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def get(self, domain: str) -> Optional[Dict]:
+        """{"scheme", "host", "sitemaps", "crawl_delay", "fresh"} for domain, or None"""
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None:
+                self._entries.move_to_end(domain)
+        
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            if entry is None:
+                row = conn.execute('''
+                    SELECT scheme, host, sitemaps, discovered_at, crawl_delay
+                    FROM discovery_cache WHERE domain = ?
+                ''', (domain,)).fetchone()
+                if row is None:
+                    return None
+                entry = {
+                    "scheme": row[0],
+                    "host": row[1],
+                    "sitemaps": row[2].split('\n'),
+                    "discovered_at": row[3],
+                    "crawl_delay": row[4]
+                }
+                with self._lock:
+                    self._remember(domain, entry)
+            
+            conn.execute('UPDATE discovery_cache SET last_used = ? WHERE domain = ?',
+                         (time.time(), domain))
+            conn.commit()
+        finally:
+            conn.close()
+        
+        return {**entry, "sitemaps": list(entry["sitemaps"]),
+                "fresh": time.time() - entry["discovered_at"] < self.ttl}
+    
+    def store(self, domain: str, scheme: str, host: str, sitemaps: List[str],
+              crawl_delay: float = None):
+        now = time.time()
+        entry = {"scheme": scheme, "host": host, "sitemaps": list(sitemaps),
+                 "discovered_at": now, "crawl_delay": crawl_delay}
+        with self._lock:
+            self._remember(domain, entry)
+        
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO discovery_cache
+                (domain, scheme, host, sitemaps, discovered_at, last_used, crawl_delay)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (domain, scheme, host, '\n'.join(sitemaps), now, now, crawl_delay))
+            
+            # Evict least recently used domains beyond the bound
+            conn.execute('''
+                DELETE FROM discovery_cache WHERE last_used < (
+                    SELECT last_used FROM discovery_cache
+                    ORDER BY last_used DESC LIMIT 1 OFFSET ?
+                )
+            ''', (self.max_entries - 1,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Warning: Could not cache discovery for {domain}: {e}")
+        finally:
+            conn.close()
+    
+    def invalidate(self, domain: str):
+        """Rediscover domain on its next crawl, still trying the known variant first"""
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None:
+                self._entries[domain] = {**entry, "discovered_at": 0}
+        
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute('UPDATE discovery_cache SET discovered_at = 0 WHERE domain = ?', (domain,))
+            conn.commit()
+        finally:
+            conn.close()
+
+# Initialize global history manager and migrate existing data
+history_manager = CrawlHistoryManager()
+history_manager.migrate_from_json()
+validator_cache = SitemapValidatorCache(history_manager.db_path)
+discovery_cache = DiscoveryCache(history_manager.db_path)
+
+# Pooled HTTP sessions
+HTTP_TIMEOUT = 10
+HTTP_POOL_MAXSIZE = 20        # keep-alive connections kept per host
+HTTP_POOL_MAX_HOSTS = 256     # idle host sessions kept before LRU eviction
+HTTP_MAX_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_CONNECT_RETRIES = 0  # DNS/refused/TLS failures fail fast instead of backing off
+
+DEFAULT_HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36'
+    ),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Number of TCP/TLS handshakes done by the current thread's request
+_connection_tracker = threading.local()
+
+def _track_connect():
+    _connection_tracker.opened = getattr(_connection_tracker, 'opened', 0) + 1
+
+def _timed_connect(connect):
+    _track_connect()
+    started = time.perf_counter()
+    try:
+        connect()
+    except Exception:
+        http_connect_seconds.observe(time.perf_counter() - started, 'error')
+        raise
+    http_connect_seconds.observe(time.perf_counter() - started)
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _timed_connect(super().connect)
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _timed_connect(super().connect)
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report every new connection"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+class CrawlStats:
+    """Thread-safe counters collected during one domain crawl"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def incr(self, name: str, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name: str):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            return dict(self._counters)
+
+class HostSessionPool:
+    """Keep-alive requests sessions, one per host, shared by all crawls"""
+
+    def __init__(self, pool_maxsize: int = HTTP_POOL_MAXSIZE,
+                 max_hosts: int = HTTP_POOL_MAX_HOSTS,
+                 max_retries: int = HTTP_MAX_RETRIES,
+                 backoff_factor: float = HTTP_BACKOFF_FACTOR):
+        self.pool_maxsize = pool_maxsize
+        self.max_hosts = max_hosts
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _create_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.max_retries,
+            connect=HTTP_CONNECT_RETRIES,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 504),
+            respect_retry_after_header=False,  # 429/503 go through http_scheduler
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False
+        )
+        adapter = CountingHTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.headers.update(DEFAULT_HEADERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self, url: str) -> requests.Session:
+        """Return the pooled session for the host of url"""
+        parts = urlsplit(url)
+        key = (parts.scheme.lower(), parts.netloc.lower())
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                return session
+
+            session = self._create_session()
+            self._sessions[key] = session
+
+            while len(self._sessions) > self.max_hosts:
+                _, evicted = self._sessions.popitem(last=False)
+                evicted.close()
+
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+http_pool = HostSessionPool()
+
+# Per-host politeness
+HOST_RATE_LIMIT = 8.0           # requests per second per host
+HOST_BURST = 16                 # requests a host may get back to back
+HOST_SCHEDULER_MAX_HOSTS = 4096
+CRAWL_DELAY_MAX = 60            # cap on a robots.txt Crawl-delay, seconds
+RATE_LIMIT_STATUSES = (429, 503)
+RATE_LIMIT_RETRIES = 2          # retries of a request answered 429/503
+RETRY_AFTER_DEFAULT = 5         # seconds, when Retry-After is missing or unreadable
+RETRY_AFTER_MAX = 120
+
+class RateLimited(Exception):
+    """429/503 answer; retry_after is how long the host asked us to wait"""
+    
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_retry_after(value: Optional[str]) -> float:
+    """Retry-After in seconds (delta or HTTP-date), capped at RETRY_AFTER_MAX"""
+    delay = RETRY_AFTER_DEFAULT
+    if value:
+        value = value.strip()
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    return min(max(delay, 0), RETRY_AFTER_MAX)
+
+def parse_crawl_delay(robots_txt: str) -> Optional[float]:
+    """Crawl-delay of the robots.txt group for all user agents (*)"""
+    applies = False
+    in_agents = False
+    for line in robots_txt.splitlines():
+        field, _, value = line.split('#', 1)[0].partition(':')
+        field, value = field.strip().lower(), value.strip()
+        if field == 'user-agent':
+            # Consecutive User-agent lines share one group
+            applies = (applies and in_agents) or value == '*'
+            in_agents = True
+            continue
+        in_agents = False
+        if field == 'crawl-delay' and applies:
+            try:
+                delay = float(value)
+            except ValueError:
+                continue
+            if delay > 0:
+                return min(delay, CRAWL_DELAY_MAX)
+    return None
+
+class _HostBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class HostScheduler:
+    """Token bucket per host, shared by every crawl and both engines
+    
+    reserve() takes the host's next slot and returns how long to wait for
+    it, so a busy host only delays requests to that host. A Crawl-delay
+    lowers the host's rate, and a 429/503 puts its bucket into debt for
+    the Retry-After period.
+    """
+    
+    def __init__(self, rate: float = HOST_RATE_LIMIT, burst: int = HOST_BURST,
+                 max_hosts: int = HOST_SCHEDULER_MAX_HOSTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_hosts = max_hosts
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def host_key(url: str) -> str:
+        return urlsplit(url).netloc.lower()
+    
+    def _bucket(self, url: str) -> _HostBucket:
+        """The host's bucket, refilled up to now; the caller holds the lock"""
+        key = self.host_key(url)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _HostBucket(self.rate, self.burst)
+            while len(self._buckets) > self.max_hosts:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        bucket.refill(time.monotonic())
+        return bucket
+    
+    def reserve(self, url: str) -> float:
+        """Take a slot for a request to url's host, return the seconds to wait for it"""
+        with self._lock:
+            bucket = self._bucket(url)
+            bucket.tokens -= 1
+            return -bucket.tokens / bucket.rate if bucket.tokens < 0 else 0
+    
+    def wait(self, url: str, stats: CrawlStats = None):
+        delay = self.reserve(url)
+        if delay > 0:
+            if stats is not None:
+                stats.incr('throttled_seconds', delay)
+            time.sleep(delay)
+    
+    async def async_wait(self, url: str, stats: CrawlStats = None):
+        delay = self.reserve(url)
+        if delay > 0:
+            if stats is not None:
+                stats.incr('throttled_seconds', delay)
+            await asyncio.sleep(delay)
+    
+    def pause(self, url: str, seconds: float):
+        """Hold back url's host for seconds, then resume with a single token"""
+        with self._lock:
+            bucket = self._bucket(url)
+            bucket.tokens = min(bucket.tokens, 1 - seconds * bucket.rate)
+    
+    def set_crawl_delay(self, url: str, delay: float):
+        """At most one request per delay seconds to url's host"""
+        with self._lock:
+            bucket = self._bucket(url)
+            bucket.rate = min(self.rate, 1 / delay)
+            bucket.burst = 1
+            bucket.tokens = min(bucket.tokens, 1)
+
+http_scheduler = HostScheduler()
+
+class HostUnreachable(Exception):
+    """DNS, connect or TLS failure: no other path on that host will answer either"""
+
+# Legacy functions (keep for backward compatibility)
+def open_url(url, stats: CrawlStats = None, headers: Dict = None):
+    """GET url through the pooled session, leaving the body unread
+    
+    Each attempt waits for its slot in http_scheduler; a 429/503 pauses
+    the host for its Retry-After and is retried up to RATE_LIMIT_RETRIES times.
+    """
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        http_scheduler.wait(url, stats)
+        try:
+            return _open_url_once(url, stats, headers)
+        except RateLimited as e:
+            http_scheduler.pause(url, e.retry_after)
+            if stats is not None:
+                stats.incr('rate_limited')
+            if attempt == RATE_LIMIT_RETRIES:
+                raise
+
+def response_outcome(status_code: int) -> str:
+    """Outcome label of an HTTP response for the request metrics"""
+    if status_code == 304:
+        return 'not_modified'
+    if status_code in RATE_LIMIT_STATUSES:
+        return 'rate_limited'
+    return 'http_error' if status_code >= 400 else 'ok'
+
+def _open_url_once(url, stats: CrawlStats = None, headers: Dict = None):
+    session = http_pool.get_session(url)
+    _connection_tracker.opened = 0
+    res = None
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        res = session.get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=True)
+        outcome = response_outcome(res.status_code)
+        res.raise_for_status()
+        return res
+    except requests.exceptions.HTTPError as e:
+        res.close()
+        if res.status_code == 403:
+            raise Exception(f"403 Forbidden – Trang từ chối truy cập: {url}")
+        if res.status_code in RATE_LIMIT_STATUSES:
+            raise RateLimited(f"Lỗi HTTP {res.status_code} – {url}",
+                              parse_retry_after(res.headers.get('Retry-After')))
+        raise Exception(f"Lỗi HTTP {res.status_code} – {url}")
+    except requests.exceptions.ConnectionError as e:
+        outcome = 'unreachable'
+        raise HostUnreachable(f"Không thể kết nối: {url} – {str(e)}")
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+    finally:
+        http_ttfb_seconds.observe(time.perf_counter() - started, outcome)
+        if stats is not None:
+            opened = _connection_tracker.opened
+            stats.incr('requests')
+            stats.incr('connections_opened', opened)
+            if opened == 0:
+                stats.incr('connections_reused')
+
+def decode_body(content: bytes, encoding: str = None) -> str:
+    """Decode a response body, gunzipping it first if it carries the gzip magic"""
+    if content.startswith(GZIP_MAGIC):
+        try:
+            content = gzip.decompress(content)
+        except (OSError, EOFError, zlib.error) as e:
+            raise Exception(f"Gzip lỗi: {str(e)}")
+    return content.decode(encoding or 'utf-8', errors='replace')
+
+def fetch_url(url, stats: CrawlStats = None):
+    res = open_url(url, stats)
+    try:
+        content = res.content
+        if content.startswith(GZIP_MAGIC):
+            return decode_body(content, res.encoding)
+        return res.text
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+    finally:
+        res.close()
+
+def is_valid_xml(text):
     try:
         ET.fromstring(text)
         return True
     except ET.ParseError:
         return False
 
-def discover_sitemaps(domain):
-    def try_fetch(domain_variant):
-        found_sitemaps = []
-        try:
-            robots_url = f"https://{domain_variant}/robots.txt"
-            robots_txt = fetch_url(robots_url)
-            if robots_txt:
-                for line in robots_txt.splitlines():
-                    if line.lower().startswith('sitemap:'):
-                        sitemap_url = line.split(':', 1)[1].strip()
-                        content = fetch_url(sitemap_url)
-                        if content and is_valid_xml(content):
-                            found_sitemaps.append(sitemap_url)
+DISCOVERY_DEADLINE = 20    # seconds for a domain's whole discovery
+DISCOVERY_STAGGER = 0.5    # head start each variant gets over the next one
+
+def host_resolves(domain_variant) -> bool:
+    """DNS pre-check, so a dead host fails before any HTTP retry and backoff"""
+    try:
+        socket.getaddrinfo(urlsplit(f"//{domain_variant}").hostname, None)
+        return True
+    except (socket.gaierror, UnicodeError, ValueError):
+        return False
+
+def discovery_timeout_error() -> Exception:
+    return Exception(f"Quá thời gian tìm sitemap ({DISCOVERY_DEADLINE}s)")
+
+def discovery_variants(domain, preferred: tuple = None) -> List[tuple]:
+    """(scheme, host) pairs to probe, the variant that worked last time first"""
+    hosts = [domain]
+    if not domain.startswith('www.'):
+        hosts.append(f"www.{domain}")
+    variants = [(scheme, host) for scheme in DISCOVERY_SCHEMES for host in hosts]
+    if preferred in variants:
+        variants.remove(preferred)
+        variants.insert(0, preferred)
+    return variants
+
+def cached_discovery(domain, stats: CrawlStats = None):
+    """(sitemaps or None, preferred variant) from the discovery cache"""
+    cached = discovery_cache.get(domain)
+    if cached is None:
+        return None, None
+    if cached["fresh"]:
+        if stats is not None:
+            stats.incr('discovery_cache_hits')
+        if cached["crawl_delay"]:
+            http_scheduler.set_crawl_delay(f"{cached['scheme']}://{cached['host']}/",
+                                           cached["crawl_delay"])
+        return cached["sitemaps"], None
+    return None, (cached["scheme"], cached["host"])
+
+def discover_sitemaps(domain, stats: CrawlStats = None, documents: Dict = None):
+    """Find a domain's sitemaps via robots.txt or the usual fallback paths
+
+    Candidates are validated by parsing their first entry; the started
+    download (see start_sitemap_document) is stored in documents so
+    process_domain carries on streaming it instead of downloading the
+    same sitemap a second time. A fresh discovery_cache entry is
+    returned without any request.
+
+    The (scheme, host) variants race each other, each starting
+    DISCOVERY_STAGGER after the previous one or as soon as it fails; the
+    first variant with sitemaps wins and the others stop at their next
+    step. DISCOVERY_DEADLINE only covers this probing (robots.txt,
+    response headers and first entries): the rest of a confirmed
+    sitemap downloads under the normal per-request timeouts.
+    """
+    if documents is None:
+        documents = {}
+    
+    sitemaps, preferred = cached_discovery(domain, stats)
+    if sitemaps is not None:
+        return sitemaps
+    
+    cancelled = threading.Event()
+    crawl_delays = {}
+    # Candidate url -> Future of its check, and final URL (after redirects)
+    # -> Future of its download: candidates naming or redirecting to the
+    # same sitemap wait on the download in flight instead of starting another
+    fetches = {}
+    downloads = {}
+    resolved = {}    # candidate url -> final URL
+    started = {}     # final URL -> start_sitemap_document result
+    stops = {}       # final URL -> stop event of its body reader
+    fetches_lock = threading.Lock()
+    
+    def try_sitemap(url):
+        with fetches_lock:
+            fetch = fetches.get(url)
+            first = fetch is None
+            if first:
+                if cancelled.is_set():
+                    return False
+                fetch = fetches[url] = Future()
+        if first:
+            try:
+                fetch.set_result(check_sitemap(url))
+            except Exception:
+                fetch.set_result(False)
+        return fetch.result()
+    
+    def check_sitemap(url) -> bool:
+        try:
+            res, cached = open_sitemap_response(url, stats)
+        except Exception:
+            return False
+        stop = threading.Event()
+        with fetches_lock:
+            final = resolved[url] = res.url
+            download = downloads.get(final)
+            shared = download is not None
+            if not shared:
+                download = downloads[final] = Future()
+                stops[final] = stop
+                if cancelled.is_set():
+                    stop.set()
+        if shared:
+            res.close()
+            return download.result()
+        try:
+            head, rest = start_sitemap_document(url, res, cached, stats, stop)
+        except Exception:
+            download.set_result(False)
+            return False
+        with fetches_lock:
+            # Discovery is over, so nobody would read the rest of this body
+            if cancelled.is_set():
+                rest.close()
+            else:
+                started[final] = head, rest
+        download.set_result(True)
+        return True
+    
+    def try_all(candidates):
+        candidates = list(dict.fromkeys(candidates))
+        if not candidates or cancelled.is_set():
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(candidates), SITEMAP_CHILD_WORKERS)) as pool:
+            valid = list(pool.map(try_sitemap, candidates))
+        # Candidates redirecting to the same sitemap count once
+        found = {}
+        for url, ok in zip(candidates, valid):
+            if ok:
+                found.setdefault(resolved[url], url)
+        return list(found.values())
+
+    def try_fetch(scheme, domain_variant):
+        if not host_resolves(domain_variant):
+            return []
+        
+        candidates = []
+        try:
+            robots_txt = fetch_url(f"{scheme}://{domain_variant}/robots.txt", stats)
+            crawl_delay = parse_crawl_delay(robots_txt)
+            if crawl_delay:
+                crawl_delays[(scheme, domain_variant)] = crawl_delay
+                http_scheduler.set_crawl_delay(f"{scheme}://{domain_variant}/", crawl_delay)
+            for line in robots_txt.splitlines():
+                if line.lower().startswith('sitemap:'):
+                    candidates.append(line.split(':', 1)[1].strip())
+        except HostUnreachable:
+            return []
         except Exception:
             pass
 
+        found_sitemaps = try_all(candidates)
         if not found_sitemaps:
-            for path in ['sitemap.xml', 'sitemap_index.xml']:
-                try:
-                    url = f"https://{domain_variant}/{path}"
-                    content = fetch_url(url)
-                    if content and is_valid_xml(content):
-                        found_sitemaps.append(url)
-                except Exception:
-                    continue
+            found_sitemaps = try_all(
+                f"{scheme}://{domain_variant}/{path}" for path in ['sitemap.xml', 'sitemap_index.xml']
+            )
+        return found_sitemaps
+
+    # Domain as entered, then with www, https before http
+    variants = discovery_variants(domain, preferred)
+    waiting = list(variants)
+    running = {}
+    found = []
+    deadline = time.monotonic() + DISCOVERY_DEADLINE
+    next_start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=len(variants))
+    try:
+        while waiting or running:
+            now = time.monotonic()
+            if now >= deadline:
+                raise discovery_timeout_error()
+            if waiting and (not running or now >= next_start):
+                variant = waiting.pop(0)
+                running[executor.submit(try_fetch, *variant)] = variant
+                next_start = now + DISCOVERY_STAGGER
+                continue
+            
+            timeout = deadline - now
+            if waiting:
+                timeout = min(timeout, next_start - now)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: variants.index(running[f])):
+                variant = running.pop(future)
+                found = future.result()
+                if found:
+                    discovery_cache.store(domain, *variant, found, crawl_delays.get(variant))
+                    return found
+        return []
+    finally:
+        # The winner's sitemaps go on streaming in process_domain; every
+        # other download stops before its next chunk. Robots.txt requests
+        # in flight finish in the background, bounded by HTTP_TIMEOUT.
+        with fetches_lock:
+            cancelled.set()
+            kept = {resolved[url] for url in found}
+            for url in found:
+                documents[url] = started.pop(resolved[url])
+            for final, stop in stops.items():
+                if final not in kept:
+                    stop.set()
+            close_documents(started)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Max concurrent child sitemap downloads per domain (separate from the domain pool)
+SITEMAP_CHILD_WORKERS = 8
+SITEMAP_CHUNK_SIZE = 64 * 1024
+# URL entries a child download thread hands to the crawl at a time
+NESTED_ENTRY_BATCH = 1000
+NESTED_CHILD_BATCHES = 2       # batches a child buffers while an earlier one is released
+
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+_URL_TAG = f'{SITEMAP_NS}url'
+_SITEMAP_TAG = f'{SITEMAP_NS}sitemap'
+_LOC_TAG = f'{SITEMAP_NS}loc'
+_LASTMOD_TAG = f'{SITEMAP_NS}lastmod'
+_CHANGEFREQ_TAG = f'{SITEMAP_NS}changefreq'
+_PRIORITY_TAG = f'{SITEMAP_NS}priority'
 
+# <changefreq> values, stored as their index
+CHANGEFREQ_VALUES = ('always', 'hourly', 'daily', 'weekly', 'monthly', 'yearly', 'never')
+_CHANGEFREQ_CODES = {value: code for code, value in enumerate(CHANGEFREQ_VALUES)}
+
+def parse_lastmod(text: str) -> Optional[int]:
+    """W3C datetime (YYYY, YYYY-MM, YYYY-MM-DD or full ISO 8601) to epoch seconds"""
+    text = text.strip()
+    try:
+        if len(text) == 4:
+            parsed = datetime(int(text), 1, 1)
+        elif len(text) == 7:
+            parsed = datetime(int(text[:4]), int(text[5:7]), 1)
+        else:
+            parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+def format_lastmod(lastmod: Optional[int]) -> str:
+    if lastmod is None:
+        return ''
+    return datetime.fromtimestamp(lastmod, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class UrlMetadata:
+    """Optional sitemap fields of one page URL
+    
+    lastmod is epoch seconds, changefreq an index into CHANGEFREQ_VALUES and
+    priority is kept in tenths, so every field is a small int.
+    """
+    __slots__ = ('lastmod', 'changefreq', 'priority')
+    
+    def __init__(self, lastmod: int = None, changefreq: int = None, priority: int = None):
+        self.lastmod = lastmod
+        self.changefreq = changefreq
+        self.priority = priority
+    
+    @classmethod
+    def from_texts(cls, lastmod: str = None, changefreq: str = None,
+                   priority: str = None) -> Optional['UrlMetadata']:
+        """Build from raw element texts; None when no field is usable"""
+        lastmod = parse_lastmod(lastmod) if lastmod else None
+        changefreq = _CHANGEFREQ_CODES.get(changefreq.strip().lower()) if changefreq else None
+        try:
+            priority = min(max(round(float(priority) * 10), 0), 10) if priority else None
+        except ValueError:
+            priority = None
+        if lastmod is None and changefreq is None and priority is None:
+            return None
+        return cls(lastmod, changefreq, priority)
+    
+    def as_row(self) -> tuple:
+        return self.lastmod, self.changefreq, self.priority
+
+class SitemapEntryParser:
+    """Incremental sitemap XML parser
+    
+    Returns ('url', loc, UrlMetadata or None) and ('sitemap', loc, lastmod)
+    entries. Every <url>/<sitemap> element is cleared and detached from its
+    parent once read, so memory stays constant regardless of document size.
+    """
+    
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._stack = []
+    
+    def feed(self, data: bytes) -> List:
+        try:
+            self._parser.feed(data)
+        except ParseError as e:
+            raise Exception(f"XML lỗi: {str(e)}")
+        return self._drain()
+    
+    def close(self) -> List:
+        try:
+            self._parser.close()
+        except ParseError as e:
+            raise Exception(f"XML lỗi: {str(e)}")
+        return self._drain()
+    
+    def _drain(self) -> List:
+        entries = []
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                self._stack.append(elem)
+                continue
+            
+            self._stack.pop()
+            if elem.tag not in (_URL_TAG, _SITEMAP_TAG):
+                continue
+            
+            fields = {child.tag: child.text for child in elem if child.text}
+            link = (fields.get(_LOC_TAG) or '').strip()
+            elem.clear()
+            if self._stack:
+                self._stack[-1].remove(elem)
+            if not link:
+                continue
+            
+            lastmod = fields.get(_LASTMOD_TAG)
+            if elem.tag == _URL_TAG:
+                meta = UrlMetadata.from_texts(lastmod, fields.get(_CHANGEFREQ_TAG),
+                                              fields.get(_PRIORITY_TAG))
+                entries.append(('url', link, meta))
+            else:
+                entries.append(('sitemap', link, parse_lastmod(lastmod) if lastmod else None))
+        return entries
+
+class GunzipDecoder:
+    """Incremental decoder that gunzips only bodies starting with the gzip magic"""
+    
+    def __init__(self):
+        self.is_gzip = None
+        self._head = b''
+        self._decompressor = None
+        self._finished = False
+    
+    def feed(self, chunk: bytes):
+        """Yield the decoded data of chunk in pieces of at most SITEMAP_CHUNK_SIZE bytes"""
+        if self.is_gzip is None:
+            self._head += chunk
+            if len(self._head) < len(GZIP_MAGIC):
+                return
+            chunk, self._head = self._head, b''
+            self.is_gzip = chunk.startswith(GZIP_MAGIC)
+            if self.is_gzip:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        
+        if not self.is_gzip:
+            if chunk:
+                yield chunk
+            return
+        
+        try:
+            while not self._finished:
+                if self._decompressor is None:
+                    if not chunk:
+                        break
+                    # Concatenated gzip members; anything else is trailing padding
+                    self._head += chunk
+                    if len(self._head) < len(GZIP_MAGIC):
+                        break
+                    chunk, self._head = self._head, b''
+                    if not chunk.startswith(GZIP_MAGIC):
+                        self._finished = True
+                        break
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                
+                # Bounded output, with the rest of the input kept in unconsumed_tail,
+                # so memory does not grow with the compression ratio
+                data = self._decompressor.decompress(chunk, SITEMAP_CHUNK_SIZE)
+                if data:
+                    yield data
+                if self._decompressor.eof:
+                    chunk = self._decompressor.unused_data
+                    self._decompressor = None
+                    continue
+                chunk = self._decompressor.unconsumed_tail
+                if not chunk and len(data) < SITEMAP_CHUNK_SIZE:
+                    break
+        except zlib.error as e:
+            raise Exception(f"Gzip lỗi: {str(e)}")
+    
+    def flush(self) -> bytes:
+        if self.is_gzip is None:
+            data, self._head = self._head, b''
+            return data
+        if not self.is_gzip or self._finished or self._decompressor is None:
+            return b''
+        return self._decompressor.flush()
+
+class SitemapBodyReader:
+    """Turns raw sitemap body chunks into filtered SitemapEntryParser entries"""
+    
+    def __init__(self, cache_writer: ValidatorCacheWriter = None):
+        self._gunzip = GunzipDecoder()
+        self._parser = SitemapEntryParser()
+        self.decompressed_bytes = 0
+        # Gets every kept entry for the validator cache when given
+        self.cache_writer = cache_writer
+    
+    def feed(self, chunk: bytes) -> List:
+        """Entries of one raw body chunk, all at once"""
+        return [entry for entries in self.iter_feed(chunk) for entry in entries]
+    
+    def iter_feed(self, chunk: bytes):
+        """Yield the entries of one raw body chunk, one list per bounded piece of XML"""
+        for data in self._gunzip.feed(chunk):
+            self.decompressed_bytes += len(data)
+            yield self._filter(self._parser.feed(data))
+    
+    def close(self) -> List:
+        data = self._gunzip.flush()
+        entries = []
+        if data:
+            self.decompressed_bytes += len(data)
+            entries = self._parser.feed(data)
+        if not self.decompressed_bytes:
+            raise Exception("Không tải được sitemap")
+        return self._filter(entries + self._parser.close())
+    
+    def _filter(self, entries: List) -> List:
+        kept = []
+        for kind, link, extra in entries:
+            # Filter out sitemap files
+            if kind == 'url' and ('sitemap.xml' in link.lower() or 'sitemap_index.xml' in link.lower()):
+                continue
+            if self.cache_writer is not None:
+                self.cache_writer.add(kind, link, extra)
+            kept.append((kind, link, extra))
+        return kept
+
+# Process-pool parsing: downloads stay on threads, gunzip + XML parsing
+# moves to worker processes so large crawls use every core
+CRAWL_MODES = ('threads', 'processes', 'async')
+PARSE_PROCESSES = os.cpu_count() or 1
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def parse_processes_available() -> bool:
+    return 'forkserver' in multiprocessing.get_all_start_methods()
+
+def parse_pool_context():
+    """forkserver context whose server process imports this module once
+
+    The pool is created while request, writer and job threads run, and
+    forking a multithreaded process can leave a child stuck on a lock
+    held at fork time. Workers are forked from the single-threaded
+    server instead; importing app starts no threads.
+    """
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """Shared parse worker pool, created on first use"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                              mp_context=parse_pool_context())
+        return _parse_pool
+
+def discard_parse_pool(pool: ProcessPoolExecutor):
+    """Drop a broken pool so the next crawl starts fresh workers"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_sitemap_body(body: bytes):
+    """Parse a whole sitemap body in a worker process
+
+    Returns (packed urls, packed nested, decompressed bytes); the packed
+    buffers are single bytes objects (see pack_url_entries), much cheaper
+    to send back than pickled lists of strings and metadata objects.
+    """
+    reader = SitemapBodyReader()
+    urls, nested = split_entries(reader.feed(body) + reader.close())
+    return pack_url_entries(urls), pack_nested_entries(nested), reader.decompressed_bytes
+
+def conditional_headers(cached: Optional[Dict]) -> Dict:
+    """If-None-Match/If-Modified-Since headers for a cached sitemap"""
+    headers = {}
+    if cached:
+        if cached["etag"]:
+            headers['If-None-Match'] = cached["etag"]
+        if cached["last_modified"]:
+            headers['If-Modified-Since'] = cached["last_modified"]
+    return headers
+
+def replay_not_modified(url, cached: Optional[Dict], stats: CrawlStats = None,
+                        index_lastmod: int = None) -> List:
+    """Entries stored for a sitemap that answered 304 Not Modified"""
+    entries = validator_cache.load_entries(url, index_lastmod) if cached else None
+    if entries is None:
+        raise Exception(f"Lỗi HTTP 304 – {url}")
+    if stats is not None:
+        stats.incr('sitemaps_not_modified')
+        stats.incr('bytes_avoided', cached["bytes_downloaded"])
+    urls, nested = entries
+    return ([('url', link, meta) for link, meta in urls]
+            + [('sitemap', link, lastmod) for link, lastmod in nested])
+
+def load_unchanged_sitemap(url, index_lastmod: Optional[int], stats: CrawlStats = None):
+    """(urls, nested) stored for a child whose index <lastmod> has not moved, or None"""
+    if index_lastmod is None:
+        return None
+    cached = validator_cache.load_unchanged(url, index_lastmod)
+    if cached is None:
+        return None
+    if stats is not None:
+        stats.incr('sitemaps_unchanged')
+        stats.incr('bytes_avoided', cached["bytes_downloaded"])
+    return cached["urls"], cached["nested"]
+
+def open_sitemap_response(url, stats: CrawlStats = None):
+    """(response, cached validators) of a sitemap request
+
+    Sends If-None-Match/If-Modified-Since when the validator cache knows
+    the URL.
+    """
+    cached = validator_cache.get_validators(url)
+    return open_url(url, stats, headers=conditional_headers(cached)), cached
+
+def stream_sitemap_document(url, stats: CrawlStats = None, index_lastmod: int = None):
+    """Stream one sitemap document, yielding SitemapEntryParser entries
+
+    A 304 replays the entries stored from the last full download.
+    index_lastmod is the <lastmod> the parent index gave this sitemap; it
+    is stored with the entries so an unchanged child can be skipped later.
+    """
+    res, cached = open_sitemap_response(url, stats)
+    yield from stream_sitemap_response(url, res, cached, stats, index_lastmod)
+
+def stream_sitemap_response(url, res, cached: Optional[Dict], stats: CrawlStats = None,
+                            index_lastmod: int = None, stop: threading.Event = None):
+    """Body half of stream_sitemap_document, for a response opened by open_sitemap_response
+
+    Once stop is set, the download fails before its next chunk.
+    """
+    if res.status_code == 304:
+        res.close()
+        yield from replay_not_modified(url, cached, stats, index_lastmod)
+        return
+    
+    etag = res.headers.get('ETag')
+    last_modified = res.headers.get('Last-Modified')
+    writer = None
+    if etag or last_modified or index_lastmod is not None:
+        writer = validator_cache.writer(url)
+    reader = SitemapBodyReader(writer)
+    
+    # Read and parse time are summed per chunk; time spent by the consumer
+    # between yields counts as neither
+    read_time = parse_time = 0.0
+    outcome = 'error'
+    try:
+        chunks = res.iter_content(chunk_size=SITEMAP_CHUNK_SIZE)
+        while True:
+            if stop is not None and stop.is_set():
+                raise Exception(f"Đã dừng tải sitemap: {url}")
+            started = time.perf_counter()
+            try:
+                chunk = next(chunks, None)
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+            finally:
+                read_time += time.perf_counter() - started
+            
+            pieces = reader.iter_feed(chunk) if chunk is not None else iter([reader.close()])
+            while True:
+                started = time.perf_counter()
+                try:
+                    entries = next(pieces, None)
+                finally:
+                    parse_time += time.perf_counter() - started
+                if entries is None:
+                    break
+                if writer is not None and writer.full:
+                    writer.flush()
+                yield from entries
+            if chunk is None:
+                break
+        outcome = 'ok'
+        
+        if writer is not None:
+            writer.commit(etag, last_modified, res.raw.tell(), index_lastmod)
+    finally:
+        if writer is not None and outcome != 'ok':
+            writer.abort()
+        download_seconds.observe(read_time, outcome)
+        parse_seconds.observe(parse_time, outcome)
+        download_bytes.inc(res.raw.tell())
+        if stats is not None:
+            # Wire bytes (before any gzip) vs. XML bytes handed to the parser
+            stats.incr('bytes_downloaded', res.raw.tell())
+            stats.incr('bytes_decompressed', reader.decompressed_bytes)
+        res.close()
+
+def pooled_sitemap_document(url, parse_pool: ProcessPoolExecutor, stats: CrawlStats = None,
+                            index_lastmod: int = None):
+    """Download one sitemap on this thread and parse it in parse_pool
+
+    Same validator handling as stream_sitemap_document, but the body is
+    read whole so it can be handed to a worker process in one piece.
+    """
+    cached = validator_cache.get_validators(url)
+    res = open_url(url, stats, headers=conditional_headers(cached))
+    
+    if res.status_code == 304:
+        res.close()
+        return split_entries(replay_not_modified(url, cached, stats, index_lastmod))
+    
+    etag = res.headers.get('ETag')
+    last_modified = res.headers.get('Last-Modified')
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        try:
+            body = b''.join(res.iter_content(chunk_size=SITEMAP_CHUNK_SIZE))
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+        wire_bytes = res.raw.tell()
+        outcome = 'ok'
+    finally:
+        download_seconds.observe(time.perf_counter() - started, outcome)
+        download_bytes.inc(res.raw.tell())
+        if stats is not None:
+            stats.incr('bytes_downloaded', res.raw.tell())
+        res.close()
+    
+    # Worker round trip plus unpacking, as this process experiences it
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        packed_urls, packed_nested, decompressed_bytes = \
+            parse_pool.submit(parse_sitemap_body, body).result()
+        urls = unpack_url_entries(packed_urls)
+        nested = unpack_nested_entries(packed_nested)
+        outcome = 'ok'
+    except BrokenProcessPool:
+        discard_parse_pool(parse_pool)
+        raise Exception(f"Tiến trình phân tích sitemap bị dừng: {url}")
+    finally:
+        parse_seconds.observe(time.perf_counter() - started, outcome)
+    if stats is not None:
+        stats.incr('bytes_decompressed', decompressed_bytes)
+
+    if etag or last_modified or index_lastmod is not None:
+        validator_cache.store(url, etag, last_modified, urls, nested,
+                              bytes_downloaded=wire_bytes, index_lastmod=index_lastmod)
+    return urls, nested
+
+def split_entries(entries):
+    """Split parser entries into ([(url, UrlMetadata)], [(sitemap url, lastmod)])"""
+    urls = []
+    nested = []
+    for kind, link, extra in entries:
+        (urls if kind == 'url' else nested).append((link, extra))
+    return urls, nested
+
+def iter_sitemap_document(url, stats: CrawlStats = None, index_lastmod: int = None,
+                          parse_pool: ProcessPoolExecutor = None):
+    """Yield the SitemapEntryParser entries of one sitemap document
+
+    A child whose index <lastmod> matches the one stored at its last
+    download is answered from the validator cache without any request.
+    With a parse_pool the body is parsed in a worker process; otherwise
+    it is streamed as it is parsed.
+    """
+    document = load_unchanged_sitemap(url, index_lastmod, stats)
+    if document is None and parse_pool is not None:
+        document = pooled_sitemap_document(url, parse_pool, stats, index_lastmod)
+    if document is None:
+        yield from stream_sitemap_document(url, stats, index_lastmod)
+        return
+    
+    urls, nested = document
+    for link, meta in urls:
+        yield 'url', link, meta
+    for link, lastmod in nested:
+        yield 'sitemap', link, lastmod
+
+def start_sitemap_document(url, res, cached: Optional[Dict], stats: CrawlStats = None,
+                           stop: threading.Event = None):
+    """Stream an opened sitemap up to its first entry, return (that entry as a list, the rest)
+
+    Raises like stream_sitemap_response when the body does not parse.
+    The rest is the still-open stream of entries; whoever takes it must
+    consume or close it.
+    """
+    entries = stream_sitemap_response(url, res, cached, stats, stop=stop)
+    return list(itertools.islice(entries, 1)), entries
+
+def close_documents(documents: Dict):
+    """Close the started sitemaps left in documents"""
+    while documents:
+        _, rest = documents.popitem()[1]
+        rest.close()
+
+def _iter_nested_sitemaps(executor, sitemap_entries, visited_sitemaps, depth, max_depth, stats,
+                          parse_pool=None, progress: 'CrawlProgress' = None,
+                          window: int = SITEMAP_CHILD_WORKERS):
+    """Yield the page URL entries of nested sitemaps as download threads parse them
+
+    At most window children are in flight. Each hands its entries over in
+    NESTED_ENTRY_BATCH batches through its own bounded queue, and children
+    are released strictly in the order they are listed, so the output
+    order does not depend on download timing while memory holds at most
+    NESTED_CHILD_BATCHES batches per child in the window. The sitemaps a
+    child lists are queued one level deeper once it is released.
+    """
+    stopped = threading.Event()
+    waiting = deque()
+    in_window = deque()
+    
+    def enqueue(entries, level):
+        for sitemap_url, lastmod in entries:
+            if sitemap_url not in visited_sitemaps:
+                visited_sitemaps.add(sitemap_url)
+                waiting.append((sitemap_url, lastmod, level))
+    
+    def hand_off(handoff, item) -> bool:
+        # Give up once the consumer is gone, so no thread blocks forever
+        while not stopped.is_set():
+            try:
+                handoff.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def stream_child(sitemap_url, lastmod, level, handoff) -> List:
+        """Hand over a child's URL entries, return the sitemaps it lists"""
+        started = time.time()
+        if progress is not None:
+            progress.sitemap_started(sitemap_url, level)
+        entries = iter_sitemap_document(sitemap_url, stats, lastmod, parse_pool)
+        batch, nested, count = [], [], 0
+        try:
+            for kind, link, extra in entries:
+                if kind != 'url':
+                    nested.append((link, extra))
+                    continue
+                batch.append((link, extra))
+                count += 1
+                if len(batch) >= NESTED_ENTRY_BATCH:
+                    if not hand_off(handoff, ('urls', batch)):
+                        return []
+                    batch = []
+            if batch:
+                hand_off(handoff, ('urls', batch))
+        except Exception as e:
+            if progress is not None:
+                progress.sitemap_finished(sitemap_url, started, level, error=e)
+            raise
+        finally:
+            entries.close()
+        if progress is not None:
+            progress.sitemap_finished(sitemap_url, started, level, count, len(nested))
+        return nested
+    
+    def fetch(sitemap_url, lastmod, level, handoff):
+        nested = []
+        try:
+            nested = stream_child(sitemap_url, lastmod, level, handoff)
+        except Exception as e:
+            print(f"Warning: Could not parse nested sitemap {sitemap_url}: {e}")
+        finally:
+            hand_off(handoff, ('done', nested))
+    
+    enqueue(sitemap_entries, depth)
+    try:
+        while waiting or in_window:
+            while waiting and len(in_window) < window:
+                sitemap_url, lastmod, level = waiting.popleft()
+                handoff = queue.Queue(maxsize=NESTED_CHILD_BATCHES)
+                executor.submit(fetch, sitemap_url, lastmod, level, handoff)
+                in_window.append((handoff, level))
+            handoff, level = in_window[0]
+            kind, payload = handoff.get()
+            if kind == 'urls':
+                yield from payload
+                continue
+            in_window.popleft()
+            if payload and level < max_depth:
+                enqueue(payload, level + 1)
+    finally:
+        stopped.set()
+
+def iter_sitemap_entries(url, visited_sitemaps=None, max_depth=10, stats: CrawlStats = None,
+                         max_workers: int = SITEMAP_CHILD_WORKERS, documents: Dict = None,
+                         parse_pool: ProcessPoolExecutor = None, progress: 'CrawlProgress' = None):
+    """Yield (page URL, UrlMetadata or None) of a sitemap, fetching nested sitemaps concurrently
+
+    documents holds sitemaps started during discovery; a root found
+    there is streamed on from where discovery stopped.
+    With a parse_pool every document is parsed in a worker process.
+    progress gets sitemap_started/finished events for nested sitemaps.
+    """
+    if visited_sitemaps is None:
+        visited_sitemaps = set()
+    
+    # Prevent infinite recursion
+    if url in visited_sitemaps:
+        return
+    
+    visited_sitemaps.add(url)
+    
+    if parse_pool is not None and not (documents and url in documents):
+        urls, nested = pooled_sitemap_document(url, parse_pool, stats)
+        yield from urls
+    else:
+        if documents and url in documents:
+            head, rest = documents.pop(url)
+        else:
+            head, rest = [], stream_sitemap_document(url, stats)
+        nested = []
+        try:
+            for kind, link, extra in itertools.chain(head, rest):
+                if kind == 'url':
+                    yield link, extra
+                else:
+                    nested.append((link, extra))
+        finally:
+            rest.close()
+    
+    if not nested or max_depth <= 1:
+        return
+    
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        yield from _iter_nested_sitemaps(executor, nested, visited_sitemaps, 2, max_depth, stats,
+                                         parse_pool, progress, max_workers)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def iter_sitemap_urls(url, visited_sitemaps=None, max_depth=10, stats: CrawlStats = None,
+                      max_workers: int = SITEMAP_CHILD_WORKERS, documents: Dict = None):
+    """Yield page URLs of a sitemap, fetching nested sitemaps concurrently"""
+    for link, _ in iter_sitemap_entries(url, visited_sitemaps, max_depth, stats,
+                                        max_workers, documents):
+        yield link
+
+def parse_sitemap(url, visited_sitemaps=None, max_depth=10, stats: CrawlStats = None,
+                  max_workers: int = SITEMAP_CHILD_WORKERS):
+    """Parse sitemap with recursion protection"""
+    return list(iter_sitemap_urls(url, visited_sitemaps, max_depth, stats, max_workers))
+
+# URL deduplication
+URL_DEDUP_MODES = ('exact', 'exact128', 'bloom')
+DEFAULT_URL_DEDUP = 'exact'
+DEDUP_INITIAL_SLOTS = 1024     # power of two
+DEDUP_MAX_LOAD = 0.6
+BLOOM_INITIAL_CAPACITY = 100_000
+BLOOM_ERROR_RATE = 0.001
+SAMPLE_URL_LIMIT = 100         # URLs kept per crawl when deduplication only counts
+
+_UINT64_MASK = (1 << 64) - 1
+
+class FingerprintSet:
+    """Exact URL dedup on 64-bit SipHash or 128-bit BLAKE2b fingerprints
+    
+    Fingerprints live in an open-addressed array of unsigned 64-bit words
+    (a zero first word means empty), about 14-27 bytes per URL for 64
+    bits instead of a set entry holding the URL string.
+    """
+    approximate = False
+    
+    def __init__(self, bits: int = 64):
+        if bits not in (64, 128):
+            raise ValueError("Fingerprint chỉ hỗ trợ 64 hoặc 128 bit")
+        self.bits = bits
+        self._words = bits // 64
+        self._count = 0
+        self._allocate(DEDUP_INITIAL_SLOTS)
+    
+    def _allocate(self, slots: int):
+        self._slots = array('Q', bytes(8 * self._words * slots))
+        self._mask = slots - 1
+        self._limit = int(slots * DEDUP_MAX_LOAD)
+    
+    def _insert(self, first: int, second: int = 0) -> bool:
+        slots, mask = self._slots, self._mask
+        index = first & mask
+        if self._words == 1:
+            while True:
+                current = slots[index]
+                if current == first:
+                    return False
+                if not current:
+                    slots[index] = first
+                    self._count += 1
+                    return True
+                index = (index + 1) & mask
+        
+        while True:
+            offset = index << 1
+            current = slots[offset]
+            if current == first and slots[offset + 1] == second:
+                return False
+            if not current:
+                slots[offset] = first
+                slots[offset + 1] = second
+                self._count += 1
+                return True
+            index = (index + 1) & mask
+    
+    def _grow(self):
+        old, words = self._slots, self._words
+        self._count = 0
+        self._allocate((self._mask + 1) * 2)
+        if words == 1:
+            for first in old:
+                if first:
+                    self._insert(first)
+        else:
+            for offset in range(0, len(old), 2):
+                if old[offset]:
+                    self._insert(old[offset], old[offset + 1])
+    
+    def add(self, url: str) -> bool:
+        """Record url, True if it was not seen before"""
+        if self._count >= self._limit:
+            self._grow()
+        # The first word is never 0, so 0 can mark an empty slot
+        if self._words == 1:
+            # str hashes are SipHash, cached on the string and stable for the process
+            return self._insert(hash(url) & _UINT64_MASK or 1)
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+        return self._insert(int.from_bytes(digest[:8], 'little') or 1,
+                            int.from_bytes(digest[8:], 'little'))
+    
+    def __len__(self) -> int:
+        return self._count
+    
+    def memory_bytes(self) -> int:
+        return len(self._slots) * self._slots.itemsize
+
+class _BloomStage:
+    __slots__ = ('bits', 'num_bits', 'num_hashes', 'capacity', 'error_rate', 'count')
+    
+    def __init__(self, capacity: int, error_rate: float):
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+
+class ScalableBloomFilter:
+    """Approximate URL dedup for counting with a bounded false-positive rate
+    
+    A new stage with twice the capacity and half the error rate is added
+    whenever the current one is full, so the total rate stays below
+    error_rate. A false positive drops a new URL as already seen, so
+    counts can come out slightly low.
+    """
+    approximate = True
+    
+    def __init__(self, capacity: int = BLOOM_INITIAL_CAPACITY, error_rate: float = BLOOM_ERROR_RATE):
+        self.error_rate = error_rate
+        self._stages = [_BloomStage(capacity, error_rate / 2)]
+        self._count = 0
+    
+    def add(self, url: str) -> bool:
+        """Record url, True if it was (probably) not seen before"""
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        
+        for stage in self._stages:
+            bits, num_bits, position = stage.bits, stage.num_bits, h1
+            for _ in range(stage.num_hashes):
+                bit = position % num_bits
+                if not bits[bit >> 3] >> (bit & 7) & 1:
+                    break
+                position += h2
+            else:
+                return False
+        
+        stage = self._stages[-1]
+        if stage.count >= stage.capacity:
+            stage = _BloomStage(stage.capacity * 2, stage.error_rate / 2)
+            self._stages.append(stage)
+        bits, num_bits, position = stage.bits, stage.num_bits, h1
+        for _ in range(stage.num_hashes):
+            bit = position % num_bits
+            bits[bit >> 3] |= 1 << (bit & 7)
+            position += h2
+        stage.count += 1
+        self._count += 1
+        return True
+    
+    def __len__(self) -> int:
+        return self._count
+    
+    def memory_bytes(self) -> int:
+        return sum(len(stage.bits) for stage in self._stages)
+
+def make_url_deduper(mode: str = DEFAULT_URL_DEDUP):
+    """Deduper for a URL_DEDUP_MODES mode: add(url) -> bool, len(), memory_bytes()"""
+    if mode == 'exact':
+        return FingerprintSet(64)
+    if mode == 'exact128':
+        return FingerprintSet(128)
+    if mode == 'bloom':
+        return ScalableBloomFilter()
+    raise ValueError(f"Chế độ dedup không hợp lệ: {mode}")
+
+# Metadata column values standing for a missing field
+_NO_LASTMOD = -(1 << 63)
+_NO_SMALL_FIELD = -1
+
+class SitemapUrls:
+    """URLs first found in one top-level sitemap, as a range of the crawl's CrawlUrls
+
+    Sized, iterated and sliced like a list without copying the crawl-wide
+    one. total counts the unique URLs the sitemap added; for an
+    approximate crawl it can exceed the kept sample in the range.
+    """
+    __slots__ = ('_urls', '_start', '_stop', 'total')
+    
+    def __init__(self, urls: List[str], start: int, stop: int, total: int):
+        self._urls = urls
+        self._start = start
+        self._stop = stop
+        self.total = total
+    
+    def __len__(self) -> int:
+        return self._stop - self._start
+    
+    def __iter__(self):
+        return itertools.islice(self._urls, self._start, self._stop)
+    
+    def __getitem__(self, index):
+        positions = range(self._start, self._stop)[index]
+        if isinstance(index, int):
+            return self._urls[positions]
+        if positions.step == 1:
+            return self._urls[positions.start:positions.stop]
+        return [self._urls[position] for position in positions]
+
+class CrawlUrls:
+    """Unique URLs of a crawl in first-seen order, with their UrlMetadata
+    
+    Exact modes keep every URL; an approximate deduper only counts, and
+    keeps the first SAMPLE_URL_LIMIT URLs as a sample. Metadata is held
+    in compact array columns, created with the first URL that has any.
+    """
+    
+    def __init__(self, mode: str = DEFAULT_URL_DEDUP):
+        self.mode = mode
+        self._seen = make_url_deduper(mode)
+        self.approximate = self._seen.approximate
+        self._urls = []
+        self._url_bytes = 0
+        self._lastmod = self._changefreq = self._priority = None
+    
+    def add(self, url: str, meta: Optional['UrlMetadata'] = None) -> bool:
+        if not self._seen.add(url):
+            return False
+        if not self.approximate or len(self._urls) < SAMPLE_URL_LIMIT:
+            if meta is not None and self._lastmod is None:
+                kept = len(self._urls)
+                self._lastmod = array('q', [_NO_LASTMOD]) * kept
+                self._changefreq = array('b', [_NO_SMALL_FIELD]) * kept
+                self._priority = array('b', [_NO_SMALL_FIELD]) * kept
+            if self._lastmod is not None:
+                if meta is None:
+                    meta = UrlMetadata()
+                self._lastmod.append(_NO_LASTMOD if meta.lastmod is None else meta.lastmod)
+                self._changefreq.append(_NO_SMALL_FIELD if meta.changefreq is None else meta.changefreq)
+                self._priority.append(_NO_SMALL_FIELD if meta.priority is None else meta.priority)
+            self._urls.append(url)
+            self._url_bytes += sys.getsizeof(url)
+        return True
+    
+    def __len__(self) -> int:
+        return len(self._seen)
+    
+    def __iter__(self):
+        return iter(self._urls)
+    
+    def items(self):
+        """(url, UrlMetadata or None) pairs of the kept URLs"""
+        if self._lastmod is None:
+            return ((url, None) for url in self._urls)
+        return zip(self._urls, map(self._metadata, self._lastmod, self._changefreq, self._priority))
+    
+    @staticmethod
+    def _metadata(lastmod: int, changefreq: int, priority: int) -> Optional['UrlMetadata']:
+        if lastmod == _NO_LASTMOD and changefreq == _NO_SMALL_FIELD and priority == _NO_SMALL_FIELD:
+            return None
+        return UrlMetadata(None if lastmod == _NO_LASTMOD else lastmod,
+                           None if changefreq == _NO_SMALL_FIELD else changefreq,
+                           None if priority == _NO_SMALL_FIELD else priority)
+    
+    def mark(self) -> tuple:
+        """Position to pass to added_since"""
+        return len(self._urls), len(self)
+    
+    def added_since(self, mark: tuple) -> SitemapUrls:
+        """URLs added after mark, without copying them"""
+        kept, total = mark
+        return SitemapUrls(self._urls, kept, len(self._urls), len(self) - total)
+    
+    def dedup_bytes(self) -> int:
+        return self._seen.memory_bytes()
+    
+    def metadata_bytes(self) -> int:
+        if self._lastmod is None:
+            return 0
+        return sum(sys.getsizeof(column) for column in (self._lastmod, self._changefreq, self._priority))
+    
+    def memory_report(self) -> Dict:
+        """Bytes of everything a crawl retains per URL
+
+        Per-sitemap results are ranges of the URL list, so these three
+        structures are all there is.
+        """
+        dedup_bytes = self.dedup_bytes()
+        # URL strings plus the list holding them, over-allocation included
+        url_bytes = self._url_bytes + sys.getsizeof(self._urls)
+        metadata_bytes = self.metadata_bytes()
+        total = len(self)
+        return {
+            "dedup_mode": self.mode,
+            "approximate": self.approximate,
+            "unique_urls": total,
+            "dedup_bytes": dedup_bytes,
+            "url_bytes": url_bytes,
+            "metadata_bytes": metadata_bytes,
+            "bytes_per_url": round((dedup_bytes + url_bytes + metadata_bytes) / total, 1) if total else 0
+        }
+
+def collect_sitemap_urls(entries, all_urls: CrawlUrls,
+                         progress: 'CrawlProgress' = None) -> SitemapUrls:
+    """Dedup one top-level sitemap's (url, metadata) entries into the crawl's set
+
+    Returns the URLs this sitemap added; one already found in an earlier
+    sitemap of the crawl is listed and counted only there.
+    """
+    mark = all_urls.mark()
+    for url, meta in entries:
+        if all_urls.add(url, meta) and progress is not None:
+            progress.url_found(url)
+    return all_urls.added_since(mark)
+
+# Crawl progress events
+PROGRESS_URL_BATCH = 500       # URLs per "urls" event
+
+class CrawlProgress:
+    """Named progress events of one domain's crawl, for /api/crawl-stream?events=1
+
+    emit(event, data) is called from the crawl thread and from child
+    download threads, so it must be thread-safe (e.g. queue.Queue.put).
+    Events: discovered, sitemap_started, sitemap_finished (with counts
+    or error) and urls, the unique URLs of the current top-level sitemap
+    in batches of batch_size.
+    """
+    
+    def __init__(self, domain: str, emit, batch_size: int = PROGRESS_URL_BATCH):
+        self.domain = domain
+        self.batch_size = batch_size
+        self._emit = emit
+        self._sitemap = None
+        self._urls = []
+    
+    def event(self, name: str, **data):
+        self._emit(name, {"domain": self.domain, **data})
+    
+    def sitemap_started(self, sitemap_url: str, depth: int = 1):
+        if depth == 1:
+            self.flush_urls()
+            self._sitemap = sitemap_url
+        self.event('sitemap_started', sitemap=sitemap_url, depth=depth)
+    
+    def sitemap_finished(self, sitemap_url: str, started: float, depth: int = 1,
+                         count: int = 0, sitemaps: int = 0, error: Exception = None):
+        if depth == 1:
+            self.flush_urls()
+        data = {"sitemap": sitemap_url, "depth": depth, "count": count,
+                "duration": round(time.time() - started, 2)}
+        if depth > 1:
+            data["sitemaps"] = sitemaps
+        if error is not None:
+            data["error"] = str(error)
+        self.event('sitemap_finished', **data)
+    
+    def url_found(self, url: str):
+        self._urls.append(url)
+        if len(self._urls) >= self.batch_size:
+            self.flush_urls()
+    
+    def flush_urls(self):
+        if self._urls:
+            self.event('urls', sitemap=self._sitemap, urls=self._urls)
+            self._urls = []
+
+def cache_summary(stats: CrawlStats) -> Dict:
+    """Cached discovery plus sitemaps answered 304 or skipped on an unchanged index <lastmod>"""
+    return {
+        "discovery": stats.get('discovery_cache_hits') > 0,
+        "not_modified": stats.get('sitemaps_not_modified'),
+        "unchanged_skipped": stats.get('sitemaps_unchanged'),
+        "bytes_avoided": stats.get('bytes_avoided')
+    }
+
+def connection_summary(stats: CrawlStats) -> Dict:
+    """Connections opened vs. reused by the pooled sessions during a crawl"""
+    return {
+        "requests": stats.get('requests'),
+        "opened": stats.get('connections_opened'),
+        "reused": stats.get('connections_reused'),
+        "rate_limited": stats.get('rate_limited'),
+        "throttled_seconds": round(stats.get('throttled_seconds'), 2)
+    }
+
+def save_enhanced_history(domain, status, total_urls=0, duration=0, 
+                         sitemaps_data=None, error_message=None, sample_urls=None,
+                         all_urls=None, metrics=None):
+    """Save crawl session with enhanced tracking"""
+    
+    return history_manager.save_crawl_session(
+        domain=domain,
+        status=status,
+        total_urls=total_urls,
+        duration=duration,
+        sitemaps_data=sitemaps_data,
+        error_message=error_message,
+        sample_urls=sample_urls,
+        all_urls=all_urls,
+        metrics=metrics
+    )
+
+def clean_domain(domain: str) -> str:
+    return domain.replace('https://', '').replace('http://', '').strip('/')
+
+def sitemap_result(sitemap_url, unique_urls: SitemapUrls, started: float, stats: CrawlStats,
+                   bytes_before: tuple) -> Dict:
+    """sitemaps_data entry for one successfully parsed top-level sitemap"""
+    downloaded_before, decompressed_before = bytes_before
+    return {
+        "sitemap": sitemap_url,
+        "count": unique_urls.total,
+        "duration": round(time.time() - started, 2),
+        "bytes_downloaded": stats.get('bytes_downloaded') - downloaded_before,
+        "bytes_decompressed": stats.get('bytes_decompressed') - decompressed_before,
+        "urls": unique_urls
+    }
+
+def sitemap_error(sitemap_url, started: float, error: Exception) -> Dict:
+    return {
+        "sitemap": sitemap_url,
+        "count": 0,
+        "duration": round(time.time() - started, 2),
+        "error": str(error)
+    }
+
+def domain_success(domain_clean, start_time: float, sitemaps_data: List[Dict],
+                   all_urls: CrawlUrls, stats: CrawlStats) -> Dict:
+    """Save a successful crawl and build the process_domain result"""
+    total_duration = time.time() - start_time
+    total_urls = len(all_urls)
+    memory = all_urls.memory_report()
+    
+    # A sitemap that moved or broke makes the cached discovery suspect
+    if any('error' in sitemap for sitemap in sitemaps_data):
+        discovery_cache.invalidate(domain_clean)
+    
+    # Save enhanced history; an approximate crawl has no full URL set to store
+    session_id = save_enhanced_history(
+        domain=domain_clean,
+        status="success",
+        total_urls=total_urls,
+        duration=total_duration,
+        sitemaps_data=sitemaps_data,
+        sample_urls=list(itertools.islice(all_urls, 100)),  # Save sample of URLs
+        all_urls=None if all_urls.approximate else all_urls,
+        metrics=[
+            ('dedup_bytes', memory["dedup_bytes"], 'bytes'),
+            ('url_bytes', memory["url_bytes"], 'bytes'),
+            ('metadata_bytes', memory["metadata_bytes"], 'bytes')
+        ]
+    )
+    
+    return {
+        "domain": domain_clean,
+        "status": "success",
+        "total_urls": total_urls,
+        "duration": total_duration,
+        "sitemaps": sitemaps_data,
+        "session_id": session_id,
+        "connections": connection_summary(stats),
+        "cache": cache_summary(stats),
+        "memory": memory
+    }
+
+def domain_failure(domain, start_time: float, error: Exception,
+                   sitemaps_data: List[Dict], stats: CrawlStats) -> Dict:
+    """Save a failed crawl and build the process_domain result"""
+    total_duration = time.time() - start_time
+    
+    # Save failed session
+    save_enhanced_history(
+        domain=domain,
+        status="failed",
+        duration=total_duration,
+        error_message=str(error),
+        sitemaps_data=sitemaps_data
+    )
+    
+    return {
+        "domain": domain,
+        "status": "failed",
+        "error": str(error),
+        "duration": total_duration,
+        "connections": connection_summary(stats)
+    }
+
+@track_domain('threads')
+def process_domain(domain, dedup: str = DEFAULT_URL_DEDUP, parse_pool: ProcessPoolExecutor = None,
+                   progress: CrawlProgress = None):
+    """Enhanced domain processing with better history tracking
+
+    With a parse_pool, sitemap bodies are parsed in worker processes while
+    downloads, deduplication and history writes stay in this process.
+    progress receives events as sitemaps are discovered and crawled.
+    """
+    
+    start_time = time.time()
+    sitemaps_data = []
+    all_urls = CrawlUrls(dedup)
+    stats = CrawlStats()
+    documents = {}
+    
+    try:
+        domain_clean = clean_domain(domain)
+        
+        sitemaps = discover_sitemaps(domain_clean, stats, documents)
+        
+        if not sitemaps:
+            raise Exception("Không tìm thấy sitemap")
+        if progress is not None:
+            progress.event('discovered', sitemaps=sitemaps)
+
+        for sitemap_url in sitemaps:
+            sitemap_start = time.time()
+            bytes_before = (stats.get('bytes_downloaded'), stats.get('bytes_decompressed'))
+            if progress is not None:
+                progress.sitemap_started(sitemap_url)
+            try:
+                # Dedup while streaming, keeping sitemap order and each URL's metadata
+                unique_urls = collect_sitemap_urls(
+                    iter_sitemap_entries(sitemap_url, stats=stats, documents=documents,
+                                         parse_pool=parse_pool, progress=progress),
+                    all_urls, progress
+                )
+                sitemaps_data.append(sitemap_result(sitemap_url, unique_urls, sitemap_start,
+                                                    stats, bytes_before))
+                if progress is not None:
+                    progress.sitemap_finished(sitemap_url, sitemap_start, count=unique_urls.total)
+            except Exception as e:
+                sitemaps_data.append(sitemap_error(sitemap_url, sitemap_start, e))
+                if progress is not None:
+                    progress.sitemap_finished(sitemap_url, sitemap_start, error=e)
+
+        return domain_success(domain_clean, start_time, sitemaps_data, all_urls, stats)
+        
+    except Exception as e:
+        return domain_failure(domain, start_time, e, sitemaps_data, stats)
+    finally:
+        close_documents(documents)
+
+def iter_crawl_events(domains, dedup: str = DEFAULT_URL_DEDUP,
+                      parse_pool: ProcessPoolExecutor = None, max_workers: int = 10):
+    """Crawl domains on threads, yielding (event, data) as they happen
+
+    Progress events are named; each domain's final result comes as
+    (None, result) with per-sitemap URL lists left out, since they were
+    already sent in "urls" batches.
+    """
+    events = queue.Queue()
+    
+    def run(domain):
+        progress = CrawlProgress(clean_domain(domain), lambda name, data: events.put((name, data)))
+        try:
+            result = process_domain(domain, dedup, parse_pool, progress)
+        except Exception as e:
+            result = {"domain": domain, "status": "failed", "error": str(e)}
+        events.put((None, job_result(result)))
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for domain in domains:
+            executor.submit(run, domain)
+        remaining = len(domains)
+        while remaining:
+            name, data = events.get()
+            if name is None:
+                remaining -= 1
+            yield name, data
+
+def iter_crawl_results(domains, dedup: str = DEFAULT_URL_DEDUP,
+                       parse_pool: ProcessPoolExecutor = None, max_workers: int = 10):
+    """Crawl domains on threads, yielding each process_domain result as it finishes"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_domain, d, dedup, parse_pool): d for d in domains}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {"domain": futures[future], "status": "failed", "error": str(e)}
+
+# Asyncio crawl engine
+ASYNC_MAX_IN_FLIGHT = 200     # requests in flight across all domains
+ASYNC_PER_HOST_LIMIT = 8      # requests in flight per host
+
+def _async_trace_config():
+    """Count new vs. reused connections into the CrawlStats passed as trace_request_ctx
+
+    Also times new connections for http_connect_seconds.
+    """
+    trace_config = aiohttp.TraceConfig()
+    
+    async def on_create_start(session, context, params):
+        context.connect_started = time.perf_counter()
+    
+    async def on_create(session, context, params):
+        http_connect_seconds.observe(time.perf_counter() - context.connect_started)
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx.incr('connections_opened')
+    
+    async def on_reuse(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx.incr('connections_reused')
+    
+    trace_config.on_connection_create_start.append(on_create_start)
+    trace_config.on_connection_create_end.append(on_create)
+    trace_config.on_connection_reuseconn.append(on_reuse)
+    return trace_config
+
+async def async_open_url(session, url, stats: CrawlStats = None, headers: Dict = None):
+    """Async counterpart of open_url; the caller must release the response"""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        await http_scheduler.async_wait(url, stats)
+        if stats is not None:
+            stats.incr('requests')
+        started = time.perf_counter()
+        try:
+            res = await session.get(url, headers=headers, trace_request_ctx=stats)
+        except aiohttp.ClientConnectorError as e:
+            http_ttfb_seconds.observe(time.perf_counter() - started, 'unreachable')
+            raise HostUnreachable(f"Không thể kết nối: {url} – {str(e)}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            http_ttfb_seconds.observe(time.perf_counter() - started, 'error')
+            raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+        http_ttfb_seconds.observe(time.perf_counter() - started, response_outcome(res.status))
+        
+        if res.status in RATE_LIMIT_STATUSES and attempt < RATE_LIMIT_RETRIES:
+            res.release()
+            http_scheduler.pause(url, parse_retry_after(res.headers.get('Retry-After')))
+            if stats is not None:
+                stats.incr('rate_limited')
+            continue
+        
+        if res.status >= 400:
+            res.release()
+            if res.status == 403:
+                raise Exception(f"403 Forbidden – Trang từ chối truy cập: {url}")
+            raise Exception(f"Lỗi HTTP {res.status} – {url}")
+        return res
+
+async def async_fetch_url(session, url, stats: CrawlStats = None) -> str:
+    res = await async_open_url(session, url, stats)
+    try:
+        content = await res.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+    finally:
+        res.release()
+    return decode_body(content, res.charset)
+
+async def async_open_sitemap_response(session, url, stats: CrawlStats = None):
+    """Async counterpart of open_sitemap_response"""
+    cached = await asyncio.to_thread(validator_cache.get_validators, url)
+    return await async_open_url(session, url, stats, headers=conditional_headers(cached)), cached
+
+async def async_stream_sitemap_document(session, url, stats: CrawlStats = None,
+                                        index_lastmod: int = None):
+    """Async counterpart of stream_sitemap_document"""
+    res, cached = await async_open_sitemap_response(session, url, stats)
+    entries = async_stream_sitemap_response(url, res, cached, stats, index_lastmod)
+    try:
+        async for entry in entries:
+            yield entry
+    finally:
+        await entries.aclose()
+
+async def async_stream_sitemap_response(url, res, cached: Optional[Dict],
+                                        stats: CrawlStats = None, index_lastmod: int = None):
+    """Async counterpart of stream_sitemap_response; a cancelled task stops it instead"""
+    if res.status == 304:
+        res.release()
+        for entry in await asyncio.to_thread(replay_not_modified, url, cached, stats, index_lastmod):
+            yield entry
+        return
+    
+    etag = res.headers.get('ETag')
+    last_modified = res.headers.get('Last-Modified')
+    writer = None
+    if etag or last_modified or index_lastmod is not None:
+        writer = validator_cache.writer(url)
+    reader = SitemapBodyReader(writer)
+    downloaded = 0
+    read_time = parse_time = 0.0
+    outcome = 'error'
+    
+    try:
+        chunks = res.content.iter_chunked(SITEMAP_CHUNK_SIZE)
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise Exception(f"Không thể kết nối: {url} – {str(e)}")
+            finally:
+                read_time += time.perf_counter() - started
+            
+            if chunk is not None:
+                downloaded += len(chunk)
+            pieces = reader.iter_feed(chunk) if chunk is not None else iter([reader.close()])
+            while True:
+                started = time.perf_counter()
+                try:
+                    entries = next(pieces, None)
+                finally:
+                    parse_time += time.perf_counter() - started
+                if entries is None:
+                    break
+                if writer is not None and writer.full:
+                    await asyncio.to_thread(writer.flush)
+                for entry in entries:
+                    yield entry
+            if chunk is None:
+                break
+        
+        if writer is not None:
+            await asyncio.to_thread(writer.commit, etag, last_modified, downloaded, index_lastmod)
+        outcome = 'ok'
+    finally:
+        if writer is not None and outcome != 'ok':
+            writer.abort()
+        download_seconds.observe(read_time, outcome)
+        parse_seconds.observe(parse_time, outcome)
+        download_bytes.inc(downloaded)
+        if stats is not None:
+            # aiohttp has already undone any Content-Encoding here
+            stats.incr('bytes_downloaded', downloaded)
+            stats.incr('bytes_decompressed', reader.decompressed_bytes)
+        res.release()
+
+async def async_iter_sitemap_document(session, url, stats: CrawlStats = None,
+                                      index_lastmod: int = None):
+    """Async counterpart of iter_sitemap_document"""
+    unchanged = await asyncio.to_thread(load_unchanged_sitemap, url, index_lastmod, stats)
+    if unchanged is None:
+        entries = async_stream_sitemap_document(session, url, stats, index_lastmod)
+        try:
+            async for entry in entries:
+                yield entry
+        finally:
+            await entries.aclose()
+        return
+    
+    urls, nested = unchanged
+    for link, meta in urls:
+        yield 'url', link, meta
+    for link, lastmod in nested:
+        yield 'sitemap', link, lastmod
+
+async def async_start_sitemap_document(url, res, cached: Optional[Dict],
+                                       stats: CrawlStats = None):
+    """Async counterpart of start_sitemap_document"""
+    entries = async_stream_sitemap_response(url, res, cached, stats)
+    try:
+        head = [await entries.__anext__()]
+    except StopAsyncIteration:
+        head = []
+    return head, entries
+
+async def async_close_documents(documents: Dict):
+    """Async counterpart of close_documents"""
+    while documents:
+        _, rest = documents.popitem()[1]
+        await rest.aclose()
+
+async def async_discover_sitemaps(session, domain, stats: CrawlStats = None, documents: Dict = None):
+    """Async counterpart of discover_sitemaps; candidates are checked concurrently
+
+    As there, DISCOVERY_DEADLINE only bounds probing; started sitemaps
+    stream on in async_process_domain.
+    """
+    if documents is None:
+        documents = {}
+    
+    sitemaps, preferred = await asyncio.to_thread(cached_discovery, domain, stats)
+    if sitemaps is not None:
+        return sitemaps
+    
+    # Candidate url -> Task of its check and final URL -> Task of its
+    # download, shared like the Futures in discover_sitemaps
+    fetches = {}
+    downloads = {}
+    resolved = {}    # candidate url -> final URL
+    started = {}     # final URL -> async_start_sitemap_document result
+    
+    async def start(url, final, res, cached):
+        try:
+            started[final] = await async_start_sitemap_document(url, res, cached, stats)
+            return True
+        except Exception:
+            return False
+    
+    async def check_sitemap(url):
+        try:
+            res, cached = await async_open_sitemap_response(session, url, stats)
+        except Exception:
+            return False
+        final = resolved[url] = str(res.url)
+        if final in downloads:
+            res.release()
+        else:
+            downloads[final] = asyncio.create_task(start(url, final, res, cached))
+        return await asyncio.shield(downloads[final])
+    
+    async def try_sitemap(url):
+        if url not in fetches:
+            fetches[url] = asyncio.create_task(check_sitemap(url))
+        # A cancelled variant must not cancel a download another one waits on
+        return await asyncio.shield(fetches[url])
+    
+    async def try_all(candidates):
+        candidates = list(dict.fromkeys(candidates))
+        valid = await asyncio.gather(*(try_sitemap(url) for url in candidates))
+        # Candidates redirecting to the same sitemap count once
+        found = {}
+        for url, ok in zip(candidates, valid):
+            if ok:
+                found.setdefault(resolved[url], url)
+        return list(found.values())
+    
+    crawl_delays = {}
+    
+    async def try_fetch(scheme, domain_variant):
+        candidates = []
+        try:
+            robots_txt = await async_fetch_url(session, f"{scheme}://{domain_variant}/robots.txt", stats)
+            crawl_delay = parse_crawl_delay(robots_txt)
+            if crawl_delay:
+                crawl_delays[(scheme, domain_variant)] = crawl_delay
+                http_scheduler.set_crawl_delay(f"{scheme}://{domain_variant}/", crawl_delay)
+            for line in robots_txt.splitlines():
+                if line.lower().startswith('sitemap:'):
+                    candidates.append(line.split(':', 1)[1].strip())
+        except HostUnreachable:
+            return []
+        except Exception:
+            pass
+        
+        found_sitemaps = await try_all(candidates)
+        if not found_sitemaps:
+            found_sitemaps = await try_all(
+                f"{scheme}://{domain_variant}/{path}" for path in ['sitemap.xml', 'sitemap_index.xml']
+            )
         return found_sitemaps
+    
+    async def race(variants):
+        # Domain as entered, then with www, https before http; losers are cancelled
+        waiting = list(variants)
+        running = {}
+        found = []
+        try:
+            while waiting or running:
+                if waiting and not running:
+                    variant = waiting.pop(0)
+                    running[asyncio.create_task(try_fetch(*variant))] = variant
+                
+                done, _ = await asyncio.wait(running, timeout=DISCOVERY_STAGGER if waiting else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    variant = waiting.pop(0)
+                    running[asyncio.create_task(try_fetch(*variant))] = variant
+                    continue
+                
+                for task in sorted(done, key=lambda t: variants.index(running[t])):
+                    variant = running.pop(task)
+                    found = task.result()
+                    if found:
+                        await asyncio.to_thread(discovery_cache.store, domain, *variant,
+                                                found, crawl_delays.get(variant))
+                        return found
+            return []
+        finally:
+            # Cancelling stops every download the winner does not use
+            for task in [*running, *fetches.values(), *downloads.values()]:
+                task.cancel()
+            for url in found:
+                documents[url] = started.pop(resolved[url])
+            await async_close_documents(started)
+    
+    try:
+        return await asyncio.wait_for(race(discovery_variants(domain, preferred)), DISCOVERY_DEADLINE)
+    except asyncio.TimeoutError:
+        raise discovery_timeout_error()
 
-    # Try domain as entered
-    sitemaps = try_fetch(domain)
-
-    # If not found and doesn't start with www, try with www
-    if not sitemaps and not domain.startswith('www.'):
-        www_domain = f"www.{domain}"
-        sitemaps = try_fetch(www_domain)
-
-    return sitemaps
+async def _async_iter_nested_sitemaps(session, sitemap_entries, visited_sitemaps, depth,
+                                     max_depth, stats, progress: CrawlProgress = None,
+                                     window: int = SITEMAP_CHILD_WORKERS):
+    """Async counterpart of _iter_nested_sitemaps
 
-def parse_sitemap(url, visited_sitemaps=None, max_depth=10):
-    """Parse sitemap with recursion protection"""
-    if visited_sitemaps is None:
-        visited_sitemaps = set()
+    Same bounded window and in-order release, with a task and an
+    asyncio.Queue per child instead of a thread and a queue.Queue.
+    """
+    waiting = deque()
+    in_window = deque()
     
-    # Prevent infinite recursion
-    if url in visited_sitemaps or len(visited_sitemaps) >= max_depth:
-        return []
+    def enqueue(entries, level):
+        for sitemap_url, lastmod in entries:
+            if sitemap_url not in visited_sitemaps:
+                visited_sitemaps.add(sitemap_url)
+                waiting.append((sitemap_url, lastmod, level))
     
-    visited_sitemaps.add(url)
-    urls = []
+    async def stream_child(sitemap_url, lastmod, level, handoff) -> List:
+        """Hand over a child's URL entries, return the sitemaps it lists"""
+        started = time.time()
+        if progress is not None:
+            progress.sitemap_started(sitemap_url, level)
+        entries = async_iter_sitemap_document(session, sitemap_url, stats, lastmod)
+        batch, nested, count = [], [], 0
+        try:
+            async for kind, link, extra in entries:
+                if kind != 'url':
+                    nested.append((link, extra))
+                    continue
+                batch.append((link, extra))
+                count += 1
+                if len(batch) >= NESTED_ENTRY_BATCH:
+                    await handoff.put(('urls', batch))
+                    batch = []
+            if batch:
+                await handoff.put(('urls', batch))
+        except Exception as e:
+            if progress is not None:
+                progress.sitemap_finished(sitemap_url, started, level, error=e)
+            raise
+        finally:
+            await entries.aclose()
+        if progress is not None:
+            progress.sitemap_finished(sitemap_url, started, level, count, len(nested))
+        return nested
     
-    xml_data = fetch_url(url)
-    if not xml_data:
-        raise Exception("Không tải được sitemap")
+    async def fetch(sitemap_url, lastmod, level, handoff):
+        # No 'done' after cancellation: nobody reads the queue any more
+        nested = []
+        try:
+            nested = await stream_child(sitemap_url, lastmod, level, handoff)
+        except Exception as e:
+            print(f"Warning: Could not parse nested sitemap {sitemap_url}: {e}")
+        await handoff.put(('done', nested))
     
+    enqueue(sitemap_entries, depth)
     try:
-        root = ET.fromstring(xml_data)
-        ns = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-        
-        for loc in root.findall('.//ns:url/ns:loc', ns):
-            link = loc.text.strip()
-            # Filter out sitemap files
-            if 'sitemap.xml' not in link.lower() and 'sitemap_index.xml' not in link.lower():
-                urls.append(link)
-
-        # Process nested sitemaps with recursion protection
-        for sitemap in root.findall('.//ns:sitemap/ns:loc', ns):
-            sitemap_url = sitemap.text.strip()
-            try:
-                nested_urls = parse_sitemap(sitemap_url, visited_sitemaps.copy(), max_depth)
-                urls.extend(nested_urls)
-            except Exception as e:
-                print(f"Warning: Could not parse nested sitemap {sitemap_url}: {e}")
+        while waiting or in_window:
+            while waiting and len(in_window) < window:
+                sitemap_url, lastmod, level = waiting.popleft()
+                handoff = asyncio.Queue(maxsize=NESTED_CHILD_BATCHES)
+                task = asyncio.create_task(fetch(sitemap_url, lastmod, level, handoff))
+                in_window.append((handoff, task, level))
+            handoff, _, level = in_window[0]
+            kind, payload = await handoff.get()
+            if kind == 'urls':
+                for entry in payload:
+                    yield entry
                 continue
-                
-    except ParseError as e:
-        raise Exception(f"XML lỗi: {str(e)}")
-    
-    return urls
+            in_window.popleft()
+            if payload and level < max_depth:
+                enqueue(payload, level + 1)
+    finally:
+        for _, task, _ in in_window:
+            task.cancel()
 
-def save_enhanced_history(domain, status, total_urls=0, duration=0, 
-                         sitemaps_data=None, error_message=None, sample_urls=None):
-    """Save crawl session with enhanced tracking"""
+async def async_iter_sitemap_entries(session, url, stats: CrawlStats = None,
+                                     documents: Dict = None, max_depth=10,
+                                     progress: CrawlProgress = None):
+    """Async counterpart of iter_sitemap_entries, yielding (URL, UrlMetadata) pairs"""
+    if documents and url in documents:
+        head, rest = documents.pop(url)
+    else:
+        head, rest = [], async_stream_sitemap_document(session, url, stats)
+    nested = []
+    try:
+        for kind, link, extra in head:
+            if kind == 'url':
+                yield link, extra
+            else:
+                nested.append((link, extra))
+        async for kind, link, extra in rest:
+            if kind == 'url':
+                yield link, extra
+            else:
+                nested.append((link, extra))
+    finally:
+        await rest.aclose()
     
-    return history_manager.save_crawl_session(
-        domain=domain,
-        status=status,
-        total_urls=total_urls,
-        duration=duration,
-        sitemaps_data=sitemaps_data,
-        error_message=error_message,
-        sample_urls=sample_urls
-    )
+    if nested and max_depth > 1:
+        async for entry in _async_iter_nested_sitemaps(session, nested, {url}, 2, max_depth,
+                                                       stats, progress):
+            yield entry
+
+async def async_collect_sitemap_urls(entries, all_urls: CrawlUrls,
+                                     progress: CrawlProgress = None) -> SitemapUrls:
+    """Async counterpart of collect_sitemap_urls for an async iterator of entries"""
+    mark = all_urls.mark()
+    async for url, meta in entries:
+        if all_urls.add(url, meta) and progress is not None:
+            progress.url_found(url)
+    return all_urls.added_since(mark)
 
-def process_domain(domain):
-    """Enhanced domain processing with better history tracking"""
+@track_domain('async')
+async def async_process_domain(session, domain, dedup: str = DEFAULT_URL_DEDUP,
+                               progress: CrawlProgress = None):
+    """Async counterpart of process_domain, returning the same result shape"""
     
     start_time = time.time()
     sitemaps_data = []
-    all_urls = set()
+    all_urls = CrawlUrls(dedup)
+    stats = CrawlStats()
+    documents = {}
     
     try:
-        domain_clean = domain.replace('https://', '').replace('http://', '').strip('/')
+        domain_clean = clean_domain(domain)
         
-        sitemaps = discover_sitemaps(domain_clean)
+        sitemaps = await async_discover_sitemaps(session, domain_clean, stats, documents)
         
         if not sitemaps:
             raise Exception("Không tìm thấy sitemap")
-
+        if progress is not None:
+            progress.event('discovered', sitemaps=sitemaps)
+        
         for sitemap_url in sitemaps:
             sitemap_start = time.time()
+            bytes_before = (stats.get('bytes_downloaded'), stats.get('bytes_decompressed'))
+            if progress is not None:
+                progress.sitemap_started(sitemap_url)
             try:
-                urls = parse_sitemap(sitemap_url)
-                sitemap_duration = time.time() - sitemap_start
-                
-                unique_urls = list(set(urls))
-                all_urls.update(unique_urls)
-                
-                sitemaps_data.append({
-                    "sitemap": sitemap_url,
-                    "count": len(unique_urls),
-                    "duration": round(sitemap_duration, 2),
-                    "urls": unique_urls
-                })
-                
+                entries = async_iter_sitemap_entries(session, sitemap_url, stats, documents,
+                                                     progress=progress)
+                unique_urls = await async_collect_sitemap_urls(entries, all_urls, progress)
+                sitemaps_data.append(sitemap_result(sitemap_url, unique_urls, sitemap_start,
+                                                    stats, bytes_before))
+                if progress is not None:
+                    progress.sitemap_finished(sitemap_url, sitemap_start, count=unique_urls.total)
             except Exception as e:
-                sitemaps_data.append({
-                    "sitemap": sitemap_url,
-                    "count": 0,
-                    "duration": round(time.time() - sitemap_start, 2),
-                    "error": str(e)
-                })
-
-        total_duration = time.time() - start_time
-        total_urls = len(all_urls)
-        
-        # Save enhanced history
-        session_id = save_enhanced_history(
-            domain=domain_clean,
-            status="success",
-            total_urls=total_urls,
-            duration=total_duration,
-            sitemaps_data=sitemaps_data,
-            sample_urls=list(all_urls)[:100]  # Save sample of URLs
-        )
-        
-        return {
-            "domain": domain_clean,
-            "status": "success",
-            "total_urls": total_urls,
-            "duration": total_duration,
-            "sitemaps": sitemaps_data,
-            "session_id": session_id
-        }
+                sitemaps_data.append(sitemap_error(sitemap_url, sitemap_start, e))
+                if progress is not None:
+                    progress.sitemap_finished(sitemap_url, sitemap_start, error=e)
         
+        return await asyncio.to_thread(domain_success, domain_clean, start_time,
+                                       sitemaps_data, all_urls, stats)
+    
     except Exception as e:
-        total_duration = time.time() - start_time
-        
-        # Save failed session
-        save_enhanced_history(
-            domain=domain,
-            status="failed",
-            duration=total_duration,
-            error_message=str(e),
-            sitemaps_data=sitemaps_data
-        )
+        return await asyncio.to_thread(domain_failure, domain, start_time, e,
+                                       sitemaps_data, stats)
+    finally:
+        await async_close_documents(documents)
+
+async def _async_crawl(domains, emit, dedup: str = DEFAULT_URL_DEDUP, emit_progress=None):
+    connector = aiohttp.TCPConnector(
+        limit=ASYNC_MAX_IN_FLIGHT,
+        limit_per_host=ASYNC_PER_HOST_LIMIT,
+        ttl_dns_cache=300
+    )
+    # Only socket-level timeouts: waiting for a free connector slot is not an error
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT)
+    
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     headers=DEFAULT_HEADERS,
+                                     trace_configs=[_async_trace_config()]) as session:
+        async def run(domain):
+            progress = None
+            if emit_progress is not None:
+                progress = CrawlProgress(clean_domain(domain), emit_progress)
+            try:
+                return await async_process_domain(session, domain, dedup, progress)
+            except Exception as e:
+                return {"domain": domain, "status": "failed", "error": str(e)}
         
-        return {
-            "domain": domain,
-            "status": "failed",
-            "error": str(e),
-            "duration": total_duration
+        for next_result in asyncio.as_completed([run(d) for d in domains]):
+            emit(await next_result)
+
+def iter_crawl_results_async(domains, dedup: str = DEFAULT_URL_DEDUP):
+    """Run the asyncio engine on a background thread, yielding results as domains finish"""
+    for _, result in _iter_async_engine(domains, dedup, progress=False):
+        yield result
+
+def iter_crawl_events_async(domains, dedup: str = DEFAULT_URL_DEDUP):
+    """Asyncio counterpart of iter_crawl_events"""
+    for name, data in _iter_async_engine(domains, dedup, progress=True):
+        yield name, data if name else job_result(data)
+
+def _iter_async_engine(domains, dedup: str, progress: bool):
+    results = queue.Queue()
+    done = object()
+    emit_progress = (lambda name, data: results.put((name, data))) if progress else None
+    
+    def runner():
+        try:
+            asyncio.run(_async_crawl(domains, lambda result: results.put((None, result)), dedup,
+                                     emit_progress))
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(done)
+    
+    threading.Thread(target=runner, daemon=True).start()
+    while True:
+        item = results.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+# Background crawl jobs
+JOB_WORKERS = 10               # domains crawled at once across all jobs
+JOB_IDLE_POLL = 5              # seconds an idle worker sleeps between queue checks
+JOB_STREAM_POLL = 1            # seconds between progress checks of a job stream
+JOB_LEASE = 60                 # seconds a running task stays claimed without a heartbeat
+JOB_HEARTBEAT = JOB_LEASE / 3  # seconds between lease renewals of running tasks
+
+class CrawlJobQueue:
+    """Persistent queue of process_domain tasks run by a bounded worker pool
+    
+    Jobs and their per-domain tasks live in SQLite, so a batch outlives
+    the request that submitted it. A running task is leased to the queue
+    that claimed it (owner, lease_expires) and kept by a heartbeat; once
+    the lease runs out, as after a crash or restart, any process sharing
+    the database may claim it again. Each finished task gets a
+    per-database done_seq, which orders results for polling and SSE
+    resumption.
+    """
+    
+    def __init__(self, db_path='crawl_history.db', workers: int = JOB_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}"
+        self._threads = []
+        self._heartbeat = None
+        self._last_resume = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._progress = threading.Condition()
+        self.init_database()
+    
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+    
+    def init_database(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                dedup TEXT NOT NULL,
+                total INTEGER NOT NULL
+            )
+        ''')
+        
+        # status: queued, running, success, failed or cancelled
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_job_tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER NOT NULL,
+                domain TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                session_id INTEGER,
+                result TEXT,
+                started_at REAL,
+                finished_at REAL,
+                done_seq INTEGER,
+                FOREIGN KEY (job_id) REFERENCES crawl_jobs (id)
+            )
+        ''')
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(crawl_job_tasks)')}
+        if 'owner' not in columns:
+            cursor.execute('ALTER TABLE crawl_job_tasks ADD COLUMN owner TEXT')
+            cursor.execute('ALTER TABLE crawl_job_tasks ADD COLUMN lease_expires REAL')
+            # Tasks left running by a version without leases are free to claim
+            cursor.execute("UPDATE crawl_job_tasks SET lease_expires = 0 WHERE status = 'running'")
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_crawl_job_tasks_status ON crawl_job_tasks(status, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_crawl_job_tasks_job ON crawl_job_tasks(job_id, done_seq)')
+        
+        conn.commit()
+        conn.close()
+    
+    def submit(self, domains: List[str], dedup: str = DEFAULT_URL_DEDUP) -> int:
+        """Queue one task per domain, return the job id"""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('INSERT INTO crawl_jobs (created_at, dedup, total) VALUES (?, ?, ?)',
+                           (time.time(), dedup, len(domains)))
+            job_id = cursor.lastrowid
+            cursor.executemany('INSERT INTO crawl_job_tasks (job_id, domain) VALUES (?, ?)',
+                               [(job_id, domain) for domain in domains])
+            conn.commit()
+        finally:
+            conn.close()
+        
+        self._ensure_workers()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return job_id
+    
+    def resume(self) -> bool:
+        """Start workers if tasks are queued or hold an expired lease
+        
+        Running tasks whose owner still renews its lease are left alone,
+        so a second process sharing the database does not re-run them.
+        """
+        conn = self.connect()
+        try:
+            pending = conn.execute('''
+                SELECT 1 FROM crawl_job_tasks
+                WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?)
+                LIMIT 1
+            ''', (time.time(),)).fetchone()
+        finally:
+            conn.close()
+        
+        if pending:
+            self._ensure_workers()
+        return pending is not None
+    
+    def resume_if_idle(self):
+        """resume(), at most every JOB_IDLE_POLL seconds and only while no worker runs"""
+        now = time.monotonic()
+        if self._threads or now - self._last_resume < JOB_IDLE_POLL:
+            return
+        self._last_resume = now
+        self.resume()
+    
+    def cancel(self, job_id: int) -> int:
+        """Cancel a job's queued tasks; running ones are left to finish"""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE crawl_job_tasks SET status = 'cancelled', finished_at = ?
+                WHERE job_id = ? AND status = 'queued'
+            ''', (time.time(), job_id))
+            cancelled = cursor.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        
+        with self._progress:
+            self._progress.notify_all()
+        return cancelled
+    
+    def _ensure_workers(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker_loop, daemon=True,
+                                          name=f'crawl-job-{len(self._threads)}')
+                thread.start()
+                self._threads.append(thread)
+            if self._heartbeat is None or not self._heartbeat.is_alive():
+                self._heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True,
+                                                   name='crawl-job-heartbeat')
+                self._heartbeat.start()
+    
+    def _heartbeat_loop(self):
+        """Renew the leases of the tasks this queue is running"""
+        while True:
+            time.sleep(JOB_HEARTBEAT)
+            conn = self.connect()
+            try:
+                conn.execute('''
+                    UPDATE crawl_job_tasks SET lease_expires = ?
+                    WHERE owner = ? AND status = 'running'
+                ''', (time.time() + JOB_LEASE, self.owner))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Warning: Could not renew crawl task leases: {e}")
+            finally:
+                conn.close()
+    
+    def queued_tasks(self) -> int:
+        """Domains waiting for a job worker"""
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM crawl_job_tasks WHERE status = 'queued'").fetchone()[0]
+        finally:
+            conn.close()
+    
+    def _claim(self):
+        """Atomically lease the oldest claimable task to this queue, return (task id, domain, dedup)
+        
+        Claimable are queued tasks and running ones whose lease expired.
+        """
+        conn = self.connect()
+        conn.isolation_level = None
+        try:
+            begin_immediate(conn, 'jobs')
+            now = time.time()
+            row = conn.execute('''
+                SELECT t.id, t.domain, j.dedup
+                FROM crawl_job_tasks t JOIN crawl_jobs j ON j.id = t.job_id
+                WHERE t.status = 'queued' OR (t.status = 'running' AND t.lease_expires < ?)
+                ORDER BY t.id LIMIT 1
+            ''', (now,)).fetchone()
+            if row:
+                conn.execute('''
+                    UPDATE crawl_job_tasks
+                    SET status = 'running', started_at = ?, owner = ?, lease_expires = ?
+                    WHERE id = ?
+                ''', (now, self.owner, now + JOB_LEASE, row[0]))
+            conn.execute('COMMIT')
+            return row
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
+    def _finish(self, task_id: int, result: Dict):
+        conn = self.connect()
+        try:
+            conn.execute('''
+                UPDATE crawl_job_tasks
+                SET status = ?, session_id = ?, result = ?, finished_at = ?,
+                    done_seq = (SELECT COALESCE(MAX(done_seq), 0) + 1 FROM crawl_job_tasks)
+                WHERE id = ? AND owner = ? AND status = 'running'
+            ''', (
+                result.get("status", "failed"), result.get("session_id"),
+                json.dumps(job_result(result), ensure_ascii=False), time.time(), task_id, self.owner
+            ))
+            conn.commit()
+        finally:
+            conn.close()
+        
+        with self._progress:
+            self._progress.notify_all()
+    
+    def _worker_loop(self):
+        while True:
+            try:
+                task = self._claim()
+            except sqlite3.Error as e:
+                print(f"Warning: Could not claim crawl task: {e}")
+                task = None
+            
+            if task is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=JOB_IDLE_POLL)
+                continue
+            
+            task_id, domain, dedup = task
+            try:
+                result = process_domain(domain, dedup)
+            except Exception as e:
+                result = {"domain": domain, "status": "failed", "error": str(e)}
+            self._finish(task_id, result)
+    
+    def get_job(self, job_id: int, include_results: bool = True) -> Optional[Dict]:
+        conn = self.connect()
+        try:
+            job = conn.execute('SELECT created_at, dedup, total FROM crawl_jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+            if job is None:
+                return None
+            
+            counts = dict(conn.execute('''
+                SELECT status, COUNT(*) FROM crawl_job_tasks WHERE job_id = ? GROUP BY status
+            ''', (job_id,)).fetchall())
+            
+            results = []
+            if include_results:
+                results = [json.loads(row[0]) for row in conn.execute('''
+                    SELECT result FROM crawl_job_tasks
+                    WHERE job_id = ? AND done_seq IS NOT NULL
+                    ORDER BY done_seq
+                ''', (job_id,))]
+        finally:
+            conn.close()
+        
+        if counts.get('running'):
+            status = 'running'
+        elif counts.get('queued'):
+            status = 'running' if len(counts) > 1 else 'queued'
+        else:
+            status = 'cancelled' if counts.get('cancelled') else 'done'
+        
+        tz = pytz.timezone("Asia/Ho_Chi_Minh")
+        job_data = {
+            "job_id": job_id,
+            "status": status,
+            "created_at": datetime.fromtimestamp(job[0], tz).strftime('%Y-%m-%d %H:%M:%S'),
+            "dedup": job[1],
+            "total": job[2],
+            "tasks": {name: counts.get(name, 0)
+                      for name in ('queued', 'running', 'success', 'failed', 'cancelled')}
         }
+        if include_results:
+            job_data["results"] = results
+        return job_data
+    
+    def iter_results(self, job_id: int, after_seq: int = 0):
+        """Yield (done_seq, result) as the job's tasks finish, until none is left to run"""
+        while True:
+            conn = self.connect()
+            try:
+                # Count first: a task finishing between the two reads is then
+                # still counted, and its result is read on this pass or the next
+                remaining = conn.execute('''
+                    SELECT COUNT(*) FROM crawl_job_tasks
+                    WHERE job_id = ? AND status IN ('queued', 'running')
+                ''', (job_id,)).fetchone()[0]
+                rows = conn.execute('''
+                    SELECT done_seq, result FROM crawl_job_tasks
+                    WHERE job_id = ? AND done_seq > ?
+                    ORDER BY done_seq
+                ''', (job_id, after_seq)).fetchall()
+            finally:
+                conn.close()
+            
+            for done_seq, result in rows:
+                after_seq = done_seq
+                yield done_seq, json.loads(result)
+            if not remaining:
+                return
+            
+            with self._progress:
+                self._progress.wait(timeout=JOB_STREAM_POLL)
+
+def job_result(result: Dict) -> Dict:
+    """process_domain result without per-sitemap URL lists (kept by jobs, sent last by event streams)
+
+    The lists stay available from /api/sessions/<id>/urls.
+    """
+    sitemaps = [{key: value for key, value in sitemap.items() if key != "urls"}
+                for sitemap in result.get("sitemaps", [])]
+    return {**result, "sitemaps": sitemaps} if "sitemaps" in result else result
+
+job_queue = CrawlJobQueue(history_manager.db_path)
+
+@app.before_request
+def resume_crawl_jobs():
+    # On the first requests rather than on import, so a script importing
+    # app never starts job workers
+    job_queue.resume_if_idle()
+
+metrics.gauge('sitemap_history_write_queue_depth', 'Crawl sessions waiting for the history writer',
+              callback=history_manager.pending_writes)
+metrics.gauge('sitemap_job_queue_depth', 'Background job domains waiting for a worker',
+              callback=job_queue.queued_tasks)
+
+# Response encoding
+COMPRESS_MIN_SIZE = 1024       # smaller bodies are sent as they are
+COMPRESS_LEVEL = 6             # gzip level
+BROTLI_QUALITY = 5             # brotli quality; 11 is far too slow for live responses
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+JSON_URL_CHUNK = 10_000        # URLs serialized per piece of a streamed crawl result
+
+class CrawlJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that also encodes SitemapUrls ranges as lists"""
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, SitemapUrls):
+            return list(o)
+        return DefaultJSONProvider.default(o)
+
+class FastJSONProvider(CrawlJSONProvider):
+    """JSON provider encoding with orjson, several times faster on URL lists
+
+    Keys stay sorted as with jsonify; non-ASCII text goes out as UTF-8
+    instead of \\u escapes. Indented output and anything orjson rejects
+    (integers beyond 64 bits, say) fall back to the stdlib encoder.
+    """
+    
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs.get("indent") is None:
+            try:
+                return orjson.dumps(obj, default=self.default, option=(
+                    orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS |
+                    orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+                )).decode('utf-8')
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
+
+app.json = FastJSONProvider(app) if orjson is not None else CrawlJSONProvider(app)
+
+def _open_object(encoded: str, key: str) -> str:
+    """'{...}' -> '{...,"key":', ready for key's value"""
+    separator = "," if encoded != "{}" else ""
+    return f'{encoded[:-1]}{separator}"{key}":'
+
+def iter_result_json(result: Dict):
+    """Serialize a crawl result piece by piece
+    
+    Each sitemap's URL list goes out JSON_URL_CHUNK URLs at a time, so a
+    domain with millions of URLs is never one string in memory. No piece
+    holds a newline, so the pieces also make up an SSE data line.
+    """
+    dumps = app.json.dumps
+    sitemaps = result.get("sitemaps")
+    if not sitemaps:
+        yield dumps(result)
+        return
+    
+    yield _open_object(dumps({k: v for k, v in result.items() if k != "sitemaps"}), "sitemaps") + "["
+    for i, sitemap in enumerate(sitemaps):
+        if i:
+            yield ","
+        urls = sitemap.get("urls")
+        if not urls:
+            yield dumps(sitemap)
+            continue
+        yield _open_object(dumps({k: v for k, v in sitemap.items() if k != "urls"}), "urls") + "["
+        for start in range(0, len(urls), JSON_URL_CHUNK):
+            chunk = dumps(urls[start:start + JSON_URL_CHUNK])[1:-1]
+            yield f",{chunk}" if start else chunk
+        yield "]}"
+    yield "]}"
+
+def iter_json_array(results):
+    """Stream a JSON array of crawl results, each serialized as it arrives"""
+    yield "["
+    for i, result in enumerate(results):
+        if i:
+            yield ","
+        yield from iter_result_json(result)
+    yield "]\n"
+
+def negotiate_encoding() -> Optional[str]:
+    """Best of br/gzip the request's Accept-Encoding allows, None for identity"""
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    """Whole body in the negotiated encoding"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+def compress_chunks(chunks, encoding: str, flush_after: bytes = None):
+    """Compress a streamed body as it is produced
+    
+    A chunk ending with flush_after (the blank line closing an SSE
+    message) is pushed to the client at once; otherwise output leaves as
+    the compressor fills. Closing this generator closes the wrapped one.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+        flush = functools.partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+    
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compress(chunk)
+            if flush_after and chunk.endswith(flush_after):
+                data += flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """gzip (or br) JSON, CSV and text responses for clients that accept it"""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None or request.method == 'HEAD':
+        return response
+    
+    if response.is_streamed:
+        event_stream = response.mimetype == 'text/event-stream'
+        response.response = compress_chunks(response.response, encoding,
+                                            flush_after=b"\n\n" if event_stream else None)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# History response cache
+HISTORY_CACHE_SIZE = 256       # cached responses across the history read endpoints
+
+class ResponseCache:
+    """LRU cache of serialized JSON responses tagged with the history generation
+
+    An entry is only served while history_manager.generation is the one
+    it was computed at; any saved session makes every entry stale.
+    """
+    
+    def __init__(self, max_entries: int = HISTORY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, generation: int) -> Optional[tuple]:
+        """(body, etag) cached for key at this generation, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != generation:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+    
+    def store(self, key, generation: int, body: bytes) -> str:
+        """Cache body for key, return its ETag"""
+        etag = f"{generation:x}-{hashlib.blake2b(body, digest_size=8).hexdigest()}"
+        with self._lock:
+            self._entries[key] = (generation, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+history_cache = ResponseCache()
+
+def cached_history_response(key, compute) -> Response:
+    """JSON response of compute(), reused until the next saved session
+
+    Carries an ETag, so a client sending it back in If-None-Match gets
+    an empty 304 instead of the body.
+    """
+    generation = history_manager.generation
+    cached = history_cache.get(key, generation)
+    if cached is None:
+        # Same bytes jsonify would send
+        body = app.json.response(compute()).get_data()
+        etag = history_cache.store(key, generation, body)
+        status = 'miss'
+    else:
+        body, etag = cached
+        status = 'hit'
+    
+    response = Response(body, mimetype='application/json')
+    # Weak, as the same body may go out gzip- or br-encoded
+    response.set_etag(etag, weak=True)
+    # Always revalidate; a matching ETag costs neither a query nor a body
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Cache'] = status
+    return response.make_conditional(request)
 
 # Routes
+def crawl_mode_error(mode) -> Optional[str]:
+    """Error message for a crawl mode this server cannot run, else None"""
+    if mode not in CRAWL_MODES:
+        return f"Chế độ crawl không hợp lệ: {mode}"
+    if mode == "async" and aiohttp is None:
+        return "Chế độ async cần cài đặt aiohttp"
+    if mode == "processes" and not parse_processes_available():
+        return "Chế độ processes cần hệ điều hành hỗ trợ forkserver"
+    return None
+
 @app.route('/')
 def index():
     return render_template("index.html")
@@ -674,31 +4639,119 @@ def crawl():
     domains = data.get("domains", [])
     if not domains:
         return jsonify({"error": "Thiếu domain"}), 400
-    results = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(process_domain, d) for d in domains]
-        for future in as_completed(futures):
-            results.append(future.result())
-    return jsonify(results)
+    dedup = data.get("dedup", DEFAULT_URL_DEDUP)
+    if dedup not in URL_DEDUP_MODES:
+        return jsonify({"error": f"Chế độ dedup không hợp lệ: {dedup}"}), 400
+    mode = data.get("mode", "threads")
+    error = crawl_mode_error(mode)
+    if error:
+        return jsonify({"error": error}), 400
+    # Streamed as domains finish; no result list or whole-body string is built
+    if mode == "async":
+        results = iter_crawl_results_async(domains, dedup)
+    else:
+        results = iter_crawl_results(domains, dedup, get_parse_pool() if mode == "processes" else None)
+    return Response(iter_json_array(results), mimetype='application/json')
 
 @app.route('/api/crawl-stream')
 def crawl_stream():
-    def stream(domains):
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {executor.submit(process_domain, d): d for d in domains}
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                except Exception as e:
-                    result = {
-                        "domain": futures[future],
-                        "status": "failed",
-                        "error": str(e)
-                    }
-                yield f"data: {json.dumps(result)}\n\n"
+    def stream(results):
+        for result in results:
+            yield "data: "
+            yield from iter_result_json(result)
+            yield "\n\n"
+    def stream_events(events):
+        # Named progress events; the per-domain result stays an unnamed message
+        for name, data in events:
+            event = f"event: {name}\n" if name else ""
+            yield f"{event}data: {app.json.dumps(data)}\n\n"
     domains = request.args.get("domains", "")
     domain_list = domains.split(",") if domains else []
-    return Response(stream(domain_list), content_type='text/event-stream')
+    dedup = request.args.get("dedup", DEFAULT_URL_DEDUP)
+    if dedup not in URL_DEDUP_MODES:
+        return jsonify({"error": f"Chế độ dedup không hợp lệ: {dedup}"}), 400
+    mode = request.args.get("mode", "threads")
+    error = crawl_mode_error(mode)
+    if error:
+        return jsonify({"error": error}), 400
+    parse_pool = get_parse_pool() if mode == "processes" else None
+    if request.args.get("events") == "1":
+        if mode == "async":
+            events = iter_crawl_events_async(domain_list, dedup)
+        else:
+            events = iter_crawl_events(domain_list, dedup, parse_pool)
+        return Response(stream_events(events), content_type='text/event-stream')
+    if mode == "async":
+        return Response(stream(iter_crawl_results_async(domain_list, dedup)), content_type='text/event-stream')
+    return Response(stream(iter_crawl_results(domain_list, dedup, parse_pool)),
+                    content_type='text/event-stream')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Crawl phase timings, counters and gauges in the Prometheus text format"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Background job API endpoints
+@app.route('/api/jobs', methods=['POST'])
+def submit_crawl_job():
+    """Queue a crawl in the background, return its job id right away"""
+    data = request.get_json() or {}
+    domains = [domain for domain in data.get("domains", []) if domain]
+    if not domains:
+        return jsonify({"error": "Thiếu domain"}), 400
+    dedup = data.get("dedup", DEFAULT_URL_DEDUP)
+    if dedup not in URL_DEDUP_MODES:
+        return jsonify({"error": f"Chế độ dedup không hợp lệ: {dedup}"}), 400
+    
+    job_id = job_queue.submit(domains, dedup)
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "total": len(domains),
+        "status_url": f"/api/jobs/{job_id}",
+        "stream_url": f"/api/jobs/{job_id}/stream"
+    }), 202
+
+@app.route('/api/jobs/<int:job_id>')
+def get_crawl_job(job_id):
+    """Job status with the results of its finished domains"""
+    include_results = request.args.get("results", "1") != "0"
+    job = job_queue.get_job(job_id, include_results=include_results)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<int:job_id>/stream')
+def stream_crawl_job(job_id):
+    """SSE of a job's domain results as they finish
+    
+    Each event carries its done_seq as id, so a reconnecting EventSource
+    (Last-Event-ID) continues where it left off; the crawl itself never
+    depends on this connection.
+    """
+    if job_queue.get_job(job_id, include_results=False) is None:
+        return jsonify({"error": "Không tìm thấy job"}), 404
+    
+    try:
+        after_seq = int(request.headers.get("Last-Event-ID") or request.args.get("after", 0))
+    except ValueError:
+        after_seq = 0
+    
+    def generate():
+        for done_seq, result in job_queue.iter_results(job_id, after_seq):
+            yield f"id: {done_seq}\ndata: {json.dumps(result)}\n\n"
+        job = job_queue.get_job(job_id, include_results=False)
+        yield f"event: done\ndata: {json.dumps(job)}\n\n"
+    
+    return Response(generate(), content_type='text/event-stream')
+
+@app.route('/api/jobs/<int:job_id>', methods=['DELETE'])
+def cancel_crawl_job(job_id):
+    """Cancel the job's domains that have not started yet"""
+    if job_queue.get_job(job_id, include_results=False) is None:
+        return jsonify({"error": "Không tìm thấy job"}), 404
+    cancelled = job_queue.cancel(job_id)
+    return jsonify({"job_id": job_id, "cancelled": cancelled})
 
 # Enhanced History API endpoints
 @app.route('/api/history')
@@ -711,17 +4764,23 @@ def get_enhanced_history():
     status_filter = request.args.get("status")
     date_from = request.args.get("date_from")
     date_to = request.args.get("date_to")
+    cursor_token = request.args.get("cursor")
     
     try:
-        result = history_manager.get_history(
-            limit=limit,
-            offset=offset,
-            domain_filter=domain_filter,
-            status_filter=status_filter,
-            date_from=date_from,
-            date_to=date_to
+        return cached_history_response(
+            ('history', limit, offset, domain_filter, status_filter, date_from, date_to, cursor_token),
+            lambda: history_manager.get_history(
+                limit=limit,
+                offset=offset,
+                domain_filter=domain_filter,
+                status_filter=status_filter,
+                date_from=date_from,
+                date_to=date_to,
+                cursor_token=cursor_token
+            )
         )
-        return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Lỗi đọc lịch sử: {str(e)}"}), 500
 
@@ -731,9 +4790,11 @@ def get_crawl_statistics():
     
     days = min(int(request.args.get("days", 30)), 365)
     
+    # The window moves at local midnight even when nothing was saved
+    today = datetime.now(HISTORY_TZ).strftime('%Y-%m-%d')
     try:
-        stats = history_manager.get_statistics(days=days)
-        return jsonify(stats)
+        return cached_history_response(('statistics', days, today),
+                                       lambda: history_manager.get_statistics(days=days))
     except Exception as e:
         return jsonify({"error": f"Lỗi tạo thống kê: {str(e)}"}), 500
 
@@ -744,26 +4805,99 @@ def compare_domain_crawls(domain):
     limit = min(int(request.args.get("limit", 5)), 20)
     
     try:
-        comparison = history_manager.compare_crawls(domain, limit)
-        return jsonify(comparison)
+        return cached_history_response(('compare', domain, limit),
+                                       lambda: history_manager.compare_crawls(domain, limit))
+    except Exception as e:
+        return jsonify({"error": f"Lỗi so sánh: {str(e)}"}), 500
+
+@app.route('/api/history/diff/<domain>')
+def diff_domain_urls(domain):
+    """Added/removed URLs between two crawls of a domain
+    
+    Defaults to the two newest crawls with stored URL sets. format=ndjson
+    streams a summary line followed by one line per changed URL.
+    """
+    
+    export_format = request.args.get("format", "json")
+    change = request.args.get("change", "all")
+    
+    try:
+        from_session = request.args.get("from", type=int)
+        to_session = request.args.get("to", type=int)
+        if from_session is None or to_session is None:
+            latest = history_manager.latest_url_set_sessions(domain, 2)
+            if len(latest) < 2:
+                return jsonify({"message": "Cần ít nhất 2 lần crawl để so sánh"}), 404
+            to_session, from_session = latest
+        
+        diff = history_manager.diff_sessions(from_session, to_session)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Lỗi so sánh: {str(e)}"}), 500
+    
+    if diff is None:
+        return jsonify({"error": "Không tìm thấy URL của phiên crawl này"}), 404
+    if diff["domain"] != domain:
+        return jsonify({"error": f"Phiên crawl không thuộc domain {domain}"}), 400
+    
+    summary = {key: value for key, value in diff.items() if not key.endswith('_bits')}
+    if export_format != "ndjson":
+        return jsonify(summary)
+    
+    def generate():
+        yield json.dumps({"type": "summary", **summary}) + "\n"
+        for kind, url in history_manager.iter_url_changes(diff, change):
+            yield json.dumps({"type": kind, "url": url}, ensure_ascii=False) + "\n"
+    
+    return Response(generate(), mimetype="application/x-ndjson")
 
 @app.route('/api/history/export')
 def export_history():
-    """Export crawl history"""
+    """Export crawl history
+    
+    Rows are streamed straight from the database, so the export covers any
+    amount of history in constant memory. days <= 0 exports everything.
+    """
     
     export_format = request.args.get("format", "csv")
-    days = min(int(request.args.get("days", 30)), 365)
+    domain_filter = request.args.get("domain")
+    status_filter = request.args.get("status")
     
     try:
-        # Get recent history
-        history_data = history_manager.get_history(limit=1000, offset=0)
-        
-        if export_format == "json":
-            return jsonify(history_data)
+        days = int(request.args.get("days", 30))
+    except ValueError:
+        return jsonify({"error": "days không hợp lệ"}), 400
+    
+    date_from = None
+    if days > 0:
+        date_from = (datetime.now(HISTORY_TZ) - timedelta(days=days)).strftime('%Y-%m-%d')
+    
+    if export_format == "json":
+        # Kept bounded for compatibility; use ndjson for full exports
+        history_data = history_manager.get_history(
+            limit=1000, offset=0, domain_filter=domain_filter,
+            status_filter=status_filter, date_from=date_from
+        )
+        return jsonify(history_data)
+    
+    sessions = history_manager.iter_sessions(
+        domain_filter=domain_filter, status_filter=status_filter, date_from=date_from
+    )
+    
+    if export_format == "ndjson":
+        def generate_ndjson():
+            for record in sessions:
+                yield json.dumps(record, ensure_ascii=False) + "\n"
         
-        # CSV export
+        return Response(
+            generate_ndjson(),
+            mimetype="application/x-ndjson",
+            headers={"Content-Disposition": "attachment; filename=crawl_history.ndjson"}
+        )
+    
+    # CSV export
+    def generate_csv():
         output = StringIO()
         writer = csv.writer(output)
         
@@ -773,8 +4907,8 @@ def export_history():
             "Duration (s)", "Sitemaps Found", "Error Message"
         ])
         
-        # Data
-        for record in history_data["results"]:
+        # Data, flushed every EXPORT_BATCH_SIZE rows
+        for count, record in enumerate(sessions, 1):
             writer.writerow([
                 record["domain"],
                 record["timestamp"],
@@ -784,30 +4918,104 @@ def export_history():
                 record["sitemaps_found"],
                 record["error_message"] or ""
             ])
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate(0)
         
-        return Response(
-            output.getvalue(),
-            mimetype="text/csv",
-            headers={"Content-Disposition": "attachment; filename=crawl_history.csv"}
-        )
+        yield output.getvalue()
+    
+    return Response(
+        generate_csv(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=crawl_history.csv"}
+    )
+
+@app.route('/api/sessions/<int:session_id>/urls')
+def export_session_urls(session_id):
+    """Stream the full URL set stored for a crawl session"""
+    
+    export_type = request.args.get("format", "txt")
+    modified_since = request.args.get("modified_since")
+    if modified_since is not None:
+        modified_since = parse_lastmod(modified_since)
+        if modified_since is None:
+            return jsonify({"error": "modified_since không hợp lệ"}), 400
+    
+    if history_manager.get_session_url_set(session_id) is None:
+        return jsonify({"error": "Không tìm thấy URL của phiên crawl này"}), 404
+    
+    if export_type == "csv":
+        rows = history_manager.iter_session_urls(session_id, with_metadata=True,
+                                                 modified_since=modified_since)
         
-    except Exception as e:
-        return jsonify({"error": f"Lỗi export: {str(e)}"}), 500
+        def generate():
+            output = StringIO()
+            writer = csv.writer(output)
+            writer.writerow(["URL", "Lastmod", "Changefreq", "Priority"])
+            for count, (url, lastmod, changefreq, priority) in enumerate(rows, 1):
+                writer.writerow([
+                    url,
+                    format_lastmod(lastmod),
+                    CHANGEFREQ_VALUES[changefreq] if changefreq is not None else "",
+                    priority / 10 if priority is not None else ""
+                ])
+                if count % EXPORT_BATCH_SIZE == 0:
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate(0)
+            yield output.getvalue()
+        
+        return Response(generate(), mimetype="text/csv",
+                        headers={"Content-Disposition": f"attachment; filename=urls_{session_id}.csv"})
+    
+    urls = history_manager.iter_session_urls(session_id, modified_since=modified_since)
+    return Response((url + "\n" for url in urls), mimetype="text/plain",
+                    headers={"Content-Disposition": f"attachment; filename=urls_{session_id}.txt"})
 
 @app.route('/api/export', methods=['POST'])
 def export_urls():
+    """Stream a URL list as TXT or CSV
+    
+    Takes either the URLs themselves ("urls") or the "session_ids" of
+    saved crawls, whose stored URL sets are read back here so the client
+    never has to send a large result set back; URLs repeated across
+    sessions are written once.
+    """
     data = request.get_json()
-    urls = data.get("urls", [])
     export_type = data.get("type", "csv")
+    session_ids = data.get("session_ids")
+    if session_ids:
+        if any(history_manager.get_session_url_set(session_id) is None for session_id in session_ids):
+            return jsonify({"error": "Không tìm thấy URL của phiên crawl này"}), 404
+        
+        def session_urls():
+            seen = FingerprintSet() if len(session_ids) > 1 else None
+            for session_id in session_ids:
+                for url in history_manager.iter_session_urls(session_id):
+                    if seen is None or seen.add(url):
+                        yield url
+        urls = session_urls()
+    else:
+        urls = data.get("urls", [])
+    
     if export_type == "txt":
-        return Response("\n".join(urls), mimetype="text/plain",
+        return Response((url + "\n" for url in urls), mimetype="text/plain",
                         headers={"Content-Disposition": "attachment; filename=urls.txt"})
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["URL"])
-    for u in urls:
-        writer.writerow([u])
-    return Response(output.getvalue(), mimetype="text/csv",
+    
+    def generate():
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["URL"])
+        for count, url in enumerate(urls, 1):
+            writer.writerow([url])
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate(0)
+        yield output.getvalue()
+    
+    return Response(generate(), mimetype="text/csv",
                     headers={"Content-Disposition": "attachment; filename=urls.csv"})
 
 if __name__ == '__main__':
@@ -0,0 +1,365 @@
+"""End-to-end crawl benchmark against local synthetic sitemap hosts
+
+Usage: python benchmarks/bench_crawl.py [--label NAME] [--compare RESULTS.json] [options]
+
+Starts benchmarks/synthetic_server.py in a subprocess and drives the app
+in-process through its Flask test client, against a scratch database:
+
+  seed          concurrent save_crawl_session calls spread over a year
+                (history writes per second)
+  crawl_cold    POST /api/crawl over fast, slow, flaky, failing and dead hosts
+  crawl_warm    the same domains again (discovery and validator caches)
+  crawl_stream  GET /api/crawl-stream?events=1 over a fresh set of hosts
+                (time to first event, per-domain completion)
+  crawl_huge    one host with --huge-urls URLs
+  history       /api/history, statistics, compare, export and session URL
+                endpoints, --history-requests times each
+
+Each scenario reports throughput, p50/p99 latency, peak RSS of this
+process and the database write rate. Results are saved as JSON under
+benchmarks/results/ (named after the git commit unless --label is given);
+--compare prints the change against an earlier results file.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+SERVER = os.path.join(ROOT, 'benchmarks', 'synthetic_server.py')
+
+# Import app from a scratch directory so its module-level history manager
+# does not touch the real crawl_history.db
+INVOKED_FROM = os.getcwd()
+SCRATCH = tempfile.mkdtemp(prefix='sitemap-bench-')
+os.chdir(SCRATCH)
+import app  # noqa: E402
+
+# Metrics shown by --compare, in this order
+COMPARED = ('elapsed_s', 'urls_per_s', 'requests_per_s', 'p50_ms', 'p99_ms', 'first_event_ms',
+            'peak_rss_mb', 'db_sessions_per_s', 'db_urls_per_s')
+
+
+class RssSampler:
+    """Peak resident set size of this process while a scenario runs"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == 'darwin' else peak * 1024
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))]
+
+
+def db_counts():
+    conn = sqlite3.connect(app.history_manager.db_path)
+    try:
+        sessions = conn.execute('SELECT COUNT(*) FROM crawl_sessions').fetchone()[0]
+        urls = conn.execute('SELECT COUNT(*) FROM url_dictionary').fetchone()[0]
+    finally:
+        conn.close()
+    return sessions, urls
+
+
+def measure(run):
+    """Run a scenario, adding elapsed time, peak RSS and database write rates"""
+    sessions_before, urls_before = db_counts()
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+    sessions_after, urls_after = db_counts()
+    result.update({
+        "elapsed_s": round(elapsed, 3),
+        "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+        "db_sessions_per_s": round((sessions_after - sessions_before) / elapsed, 1),
+        "db_urls_per_s": round((urls_after - urls_before) / elapsed, 1)
+    })
+    return result
+
+
+def latency_summary(seconds):
+    p50 = percentile(seconds, 50)
+    p99 = percentile(seconds, 99)
+    return {
+        "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+        "p99_ms": round(p99 * 1000, 1) if p99 is not None else None
+    }
+
+
+def crawl_summary(results, elapsed):
+    urls = sum(result.get("total_urls", 0) for result in results)
+    return {
+        "domains": len(results),
+        "succeeded": sum(1 for result in results if result.get("status") == "success"),
+        "urls": urls,
+        "urls_per_s": round(urls / elapsed, 1) if elapsed else None,
+        **latency_summary([result.get("duration", 0) for result in results])
+    }
+
+
+def scenario_seed(sessions, threads=10):
+    """Concurrent history writes spread over the last year"""
+    now = datetime.now()
+    step = timedelta(days=365) / max(sessions, 1)
+
+    def save(i):
+        timestamp = (now - i * step).strftime('%Y-%m-%d %H:%M:%S')
+        failed = i % 10 == 0
+        domain = f"seed-{i % 200}.test"
+        return app.history_manager.save_crawl_session(
+            domain=domain,
+            status="failed" if failed else "success",
+            total_urls=0 if failed else 1000 + i % 500,
+            duration=1.0 + i % 7,
+            sitemaps_data=[{"sitemap": f"https://{domain}/sitemap.xml", "count": 1000, "duration": 0.5}],
+            error_message="Không tìm thấy sitemap" if failed else None,
+            sample_urls=[f"https://{domain}/p{n}" for n in range(20)],
+            timestamp_override=timestamp
+        )
+
+    def run():
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            ids = list(executor.map(save, range(sessions)))
+        elapsed = time.perf_counter() - start
+        return {"sessions": sessions, "failed_writes": ids.count(None),
+                "requests_per_s": round(sessions / elapsed, 1)}
+
+    return measure(run)
+
+
+def scenario_crawl(client, domains, mode):
+    def run():
+        start = time.perf_counter()
+        response = client.post('/api/crawl', json={"domains": domains, "mode": mode})
+        results = response.get_json()
+        if response.status_code != 200:
+            raise SystemExit(f"/api/crawl failed: {results}")
+        return crawl_summary(results, time.perf_counter() - start)
+
+    return measure(run)
+
+
+def scenario_stream(client, domains, mode):
+    def run():
+        start = time.perf_counter()
+        response = client.get(f"/api/crawl-stream?events=1&mode={mode}&domains={','.join(domains)}",
+                              buffered=False)
+        first_event = None
+        events = 0
+        finished = []
+        results = []
+        buffer = b''
+        for chunk in response.response:
+            buffer += chunk
+            while b'\n\n' in buffer:
+                event, buffer = buffer.split(b'\n\n', 1)
+                now = time.perf_counter() - start
+                if first_event is None:
+                    first_event = now
+                events += 1
+                lines = event.decode('utf-8').split('\n')
+                if not lines[0].startswith('event:'):
+                    results.append(json.loads(lines[-1][len('data: '):]))
+                    finished.append(now)
+        elapsed = time.perf_counter() - start
+        summary = crawl_summary(results, elapsed)
+        summary.update(latency_summary(finished))
+        summary["events"] = events
+        summary["first_event_ms"] = round(first_event * 1000, 1) if first_event is not None else None
+        return summary
+
+    return measure(run)
+
+
+def scenario_history(client, domain, session_id, requests):
+    today = datetime.now(app.HISTORY_TZ).strftime('%Y-%m-%d')
+    endpoints = {
+        "history": "/api/history?limit=20",
+        "history_filtered": f"/api/history?limit=20&status=success&date_from={today}",
+        "statistics": "/api/history/statistics?days=365",
+        "compare": f"/api/history/compare/{domain}",
+        "export_ndjson": "/api/history/export?format=ndjson&days=0",
+        "session_urls": f"/api/sessions/{session_id}/urls?format=csv"
+    }
+
+    def run():
+        per_endpoint = {}
+        timings = []
+        start = time.perf_counter()
+        for name, path in endpoints.items():
+            seconds = []
+            for _ in range(requests):
+                began = time.perf_counter()
+                response = client.get(path)
+                response.get_data()
+                seconds.append(time.perf_counter() - began)
+                if response.status_code != 200:
+                    raise SystemExit(f"{path} answered {response.status_code}")
+            per_endpoint[name] = latency_summary(seconds)
+            timings.extend(seconds)
+        elapsed = time.perf_counter() - start
+        return {"requests": len(timings), "requests_per_s": round(len(timings) / elapsed, 1),
+                **latency_summary(timings), "endpoints": per_endpoint}
+
+    return measure(run)
+
+
+def start_server(args, sites):
+    command = [sys.executable, SERVER, '--sites', sites, '--children', str(args.children),
+               '--urls', str(args.urls), '--huge-urls', str(args.huge_urls),
+               '--latency', str(args.latency), '--slow-latency', str(args.slow_latency)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line:
+        raise SystemExit("synthetic server did not start")
+    return server, json.loads(line)["sites"]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', 'app.py'], cwd=ROOT).returncode
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_scenario(name, result):
+    shown = ', '.join(f"{key}={result[key]}" for key in COMPARED if result.get(key) is not None)
+    print(f"{name:<14} {shown}")
+
+
+def compare(baseline, current):
+    print(f"\nvs. {baseline.get('label')} ({baseline.get('commit')})")
+    for name, result in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for key in COMPARED:
+            old, new = before.get(key), result.get(key)
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+7.1f}%" if old else '    n/a'
+            print(f"{name:<14} {key:<18} {old:>12} -> {new:<12} {change}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="End-to-end crawl benchmark")
+    parser.add_argument('--label', help="results file name (default: git commit)")
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    parser.add_argument('--mode', default='threads', choices=app.CRAWL_MODES)
+    parser.add_argument('--sites', default='fast:4,slow:1,flaky:1,failing:1,dead:1',
+                        help="host mix for the crawl scenarios (see synthetic_server.py)")
+    parser.add_argument('--children', type=int, default=20)
+    parser.add_argument('--urls', type=int, default=1000)
+    parser.add_argument('--huge-urls', type=int, default=1_000_000, help="0 skips crawl_huge")
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--slow-latency', type=float, default=0.25)
+    parser.add_argument('--seed-sessions', type=int, default=2000)
+    parser.add_argument('--history-requests', type=int, default=20)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    sites = f"{args.sites},{args.sites}" + (",huge:1" if args.huge_urls > 0 else "")
+    server, hosts = start_server(args, sites)
+    group = len(hosts) // 2
+    crawl_domains = [host["domain"] for host in hosts[:group]]
+    stream_domains = [host["domain"] for host in hosts[group:2 * group]]
+    huge_domains = [host["domain"] for host in hosts[2 * group:]]
+    client = app.app.test_client()
+    print(f"{len(hosts)} synthetic hosts, mode {args.mode}, {os.cpu_count()} CPUs, scratch {SCRATCH}")
+
+    scenarios = {}
+    try:
+        scenarios["seed"] = scenario_seed(args.seed_sessions)
+        print_scenario("seed", scenarios["seed"])
+        scenarios["crawl_cold"] = scenario_crawl(client, crawl_domains, args.mode)
+        print_scenario("crawl_cold", scenarios["crawl_cold"])
+        scenarios["crawl_warm"] = scenario_crawl(client, crawl_domains, args.mode)
+        print_scenario("crawl_warm", scenarios["crawl_warm"])
+        scenarios["crawl_stream"] = scenario_stream(client, stream_domains, args.mode)
+        print_scenario("crawl_stream", scenarios["crawl_stream"])
+        if huge_domains:
+            scenarios["crawl_huge"] = scenario_crawl(client, huge_domains, args.mode)
+            print_scenario("crawl_huge", scenarios["crawl_huge"])
+
+        latest = app.history_manager.get_history(limit=1, domain_filter=crawl_domains[0])["results"][0]
+        scenarios["history"] = scenario_history(client, latest["domain"], latest["id"],
+                                                args.history_requests)
+        print_scenario("history", scenarios["history"])
+    finally:
+        server.terminate()
+        server.wait()
+
+    commit = git_commit()
+    report = {
+        "label": args.label or commit or datetime.now().strftime('%Y%m%d-%H%M%S'),
+        "commit": commit,
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": {key: value for key, value in vars(args).items() if key not in ('label', 'compare')},
+        "scenarios": scenarios
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{report['label']}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {path}")
+
+    if args.compare:
+        with open(os.path.join(INVOKED_FROM, args.compare)) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
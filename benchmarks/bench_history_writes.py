@@ -0,0 +1,96 @@
+"""Benchmark crawl-session writes: legacy per-row inserts vs. the batched writer
+
+Usage: python benchmarks/bench_history_writes.py [sessions] [threads]
+
+Both variants write the same synthetic sessions from concurrent threads
+into a scratch database and report sessions per second and the number
+of "database is locked" failures.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Import app from a scratch directory so its module-level history manager
+# does not touch the real crawl_history.db
+SCRATCH = tempfile.mkdtemp(prefix='sitemap-bench-')
+os.chdir(SCRATCH)
+import app  # noqa: E402
+
+
+def make_session(i):
+    sitemaps = [
+        {"sitemap": f"https://site{i}.test/sitemap-{n}.xml", "count": 500, "duration": 0.4}
+        for n in range(5)
+    ]
+    sample = [f"https://site{i}.test/product/{n}" for n in range(100)]
+    return dict(domain=f"site{i}.test", status="success", total_urls=2500,
+                duration=2.0, sitemaps_data=sitemaps, sample_urls=sample)
+
+
+def legacy_save(db_path, session):
+    """The pre-batching save_crawl_session: one connection and INSERT per row"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT INTO crawl_sessions
+            (domain, timestamp, status, total_urls, duration_sec, sitemaps_found, error_message)
+            VALUES (?, datetime('now'), ?, ?, ?, ?, NULL)
+        ''', (session["domain"], session["status"], session["total_urls"],
+              session["duration"], len(session["sitemaps_data"])))
+        session_id = cursor.lastrowid
+        for sitemap in session["sitemaps_data"]:
+            cursor.execute('''
+                INSERT INTO sitemap_results
+                (session_id, sitemap_url, urls_found, processing_time, status, error_message)
+                VALUES (?, ?, ?, ?, 'success', NULL)
+            ''', (session_id, sitemap["sitemap"], sitemap["count"], sitemap["duration"]))
+        for url in session["sample_urls"][:50]:
+            cursor.execute('INSERT INTO sample_urls (session_id, url, url_type) VALUES (?, ?, ?)',
+                           (session_id, url, 'page'))
+        conn.commit()
+        return session_id
+    except sqlite3.Error:
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+
+def run(label, save, sessions, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(save, [make_session(i) for i in range(sessions)]))
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for r in results if r is None)
+    print(f"{label:<10} {sessions / elapsed:10.1f} sessions/s   {failed} failed   ({elapsed:.2f}s)")
+    return sessions / elapsed
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(f"{sessions} sessions from {threads} threads")
+
+    legacy_db = os.path.join(SCRATCH, 'legacy.db')
+    manager = app.CrawlHistoryManager(db_path=legacy_db)
+    # The legacy code ran in the default rollback-journal mode
+    conn = sqlite3.connect(legacy_db)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    before = run('legacy', lambda s: legacy_save(legacy_db, s), sessions, threads)
+
+    manager = app.CrawlHistoryManager(db_path=os.path.join(SCRATCH, 'batched.db'))
+    after = run('batched', lambda s: manager.save_crawl_session(**s), sessions, threads)
+
+    print(f"speedup    {after / before:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
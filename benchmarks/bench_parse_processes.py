@@ -0,0 +1,92 @@
+"""Benchmark sitemap parsing on threads vs. the process parse pool
+
+Usage: python benchmarks/bench_parse_processes.py [sitemaps] [urls_per_sitemap] [max_workers]
+
+Parses the same synthetic sitemap bodies (every other one gzipped) with
+a thread pool, which the GIL keeps on one core, and with forkserver
+process pools of 1..max_workers workers returning compact buffers as
+process mode does. A pool returning pickled entry lists is timed at the
+largest size for comparison. Reports URLs per second for each.
+"""
+import gzip
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Import app from a scratch directory so its module-level history manager
+# does not touch the real crawl_history.db
+SCRATCH = tempfile.mkdtemp(prefix='sitemap-bench-')
+os.chdir(SCRATCH)
+import app  # noqa: E402
+
+
+def make_body(i, urls):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for n in range(urls):
+        lines.append(f'<url><loc>https://site.test/s{i}/product-{n}.html</loc>'
+                     f'<lastmod>2024-01-{n % 28 + 1:02d}</lastmod>'
+                     f'<changefreq>daily</changefreq><priority>0.{n % 10}</priority></url>')
+    lines.append('</urlset>')
+    body = '\n'.join(lines).encode('utf-8')
+    return gzip.compress(body) if i % 2 else body
+
+
+def parse_to_lists(body):
+    """(urls, nested) entry lists; pickled on the way back when run in a worker"""
+    reader = app.SitemapBodyReader(collect=True)
+    reader.feed(body)
+    reader.close()
+    return reader.collected
+
+
+def unpack_buffers(result):
+    packed_urls, packed_nested, _ = result
+    return app.unpack_url_entries(packed_urls), app.unpack_nested_entries(packed_nested)
+
+
+def run(label, bodies, executor, parse, unpack=None):
+    start = time.perf_counter()
+    total = 0
+    for result in executor.map(parse, bodies):
+        urls, _ = unpack(result) if unpack else result
+        total += len(urls)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {total / elapsed:12.0f} URLs/s   ({elapsed:.2f}s)")
+    return total / elapsed
+
+
+def main():
+    sitemaps = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    urls = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else (os.cpu_count() or 1)
+    if not app.parse_processes_available():
+        sys.exit("process mode needs the forkserver start method")
+    bodies = [make_body(i, urls) for i in range(sitemaps)]
+    print(f"{sitemaps} sitemaps x {urls} URLs, {os.cpu_count()} CPUs")
+
+    with ThreadPoolExecutor(max_workers=app.SITEMAP_CHILD_WORKERS) as executor:
+        baseline = run('threads', bodies, executor, parse_to_lists)
+
+    context = app.parse_pool_context()
+    workers = 1
+    while True:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            rate = run(f'processes x{workers}', bodies, executor,
+                       app.parse_sitemap_body, unpack_buffers)
+        print(f"{'':<22} {rate / baseline:12.2f}x threads")
+        if workers >= max_workers:
+            break
+        workers = min(workers * 2, max_workers)
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        run(f'pickled lists x{max_workers}', bodies, executor, parse_to_lists)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""Local synthetic sitemap hosts for the crawl benchmarks
+
+Usage: python benchmarks/synthetic_server.py [--sites fast:4,slow:1,...] [options]
+
+Every site listens on its own 127.0.0.1 port, so each one is a separate
+domain to the crawler. Once the sites are up, one JSON line listing them
+is printed ({"sites": [{"profile", "domain"}, ...]}), and they are served
+until the process is terminated.
+
+Profiles:
+  fast     robots.txt -> sitemap index -> sub-indexes -> children
+           (every other child gzipped), with ETag/Last-Modified
+  slow     like fast, with --slow-latency added to every response
+  flaky    like fast, but every third child answers 500
+  failing  every path answers 500
+  dead     a port nobody listens on (connection refused)
+  huge     --huge-urls URLs in gzipped children of 50,000 each
+
+Content is deterministic, so runs on different commits crawl the same
+URLs.
+"""
+import argparse
+import gzip
+import json
+import socket
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+PROFILES = ('fast', 'slow', 'flaky', 'failing', 'dead', 'huge')
+HUGE_CHILD_URLS = 50_000
+SUB_INDEXES = 2
+LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+def parse_sites(text):
+    """'fast:4,slow:1' -> ['fast', 'fast', 'fast', 'fast', 'slow']"""
+    sites = []
+    for item in filter(None, text.split(',')):
+        profile, _, count = item.partition(':')
+        if profile not in PROFILES:
+            raise ValueError(f"unknown profile: {profile}")
+        sites.extend([profile] * int(count or 1))
+    return sites
+
+
+class Site:
+    """Layout and cached bodies of one synthetic host"""
+
+    def __init__(self, profile, port, options):
+        self.profile = profile
+        self.port = port
+        self.origin = f"http://127.0.0.1:{port}"
+        self.latency = options.latency + (options.slow_latency if profile == 'slow' else 0)
+        if profile == 'huge':
+            self.children = -(-options.huge_urls // HUGE_CHILD_URLS)
+            self.urls_per_child = HUGE_CHILD_URLS
+        else:
+            self.children = options.children
+            self.urls_per_child = options.urls
+        self.total_urls = options.huge_urls if profile == 'huge' else self.children * self.urls_per_child
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def child_path(self, i):
+        gzipped = self.profile == 'huge' or i % 2
+        return f"/child-{i}.xml{'.gz' if gzipped else ''}"
+
+    def body(self, path):
+        """(body, content type) for a path, or None for 404"""
+        with self._lock:
+            if path not in self._bodies:
+                self._bodies[path] = self._render(path)
+            return self._bodies[path]
+
+    def _render(self, path):
+        if path == '/robots.txt':
+            text = f"User-agent: *\nDisallow: /private/\nSitemap: {self.origin}/sitemap_index.xml\n"
+            return text.encode(), 'text/plain'
+        if path == '/sitemap_index.xml':
+            return self._index([f"/sub-index-{n}.xml" for n in range(SUB_INDEXES)]), 'application/xml'
+        if path.startswith('/sub-index-'):
+            n = int(path[len('/sub-index-'):-len('.xml')])
+            children = [self.child_path(i) for i in range(n, self.children, SUB_INDEXES)]
+            return self._index(children), 'application/xml'
+        if path.startswith('/child-'):
+            i = int(path[len('/child-'):].split('.')[0])
+            if i >= self.children or path != self.child_path(i):
+                return None
+            body = self._urlset(i)
+            if path.endswith('.gz'):
+                return gzip.compress(body, compresslevel=6), 'application/x-gzip'
+            return body, 'application/xml'
+        return None
+
+    def _index(self, paths):
+        items = ''.join(f"<sitemap><loc>{self.origin}{path}</loc>"
+                        f"<lastmod>2024-01-01</lastmod></sitemap>" for path in paths)
+        return f'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{NS}">{items}</sitemapindex>'.encode()
+
+    def _urlset(self, i):
+        count = min(self.urls_per_child, self.total_urls - i * self.urls_per_child)
+        parts = [f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{NS}">\n']
+        for n in range(count):
+            parts.append(f"<url><loc>https://{self.profile}-{self.port}.test/c{i}/product-{n}.html</loc>"
+                         f"<lastmod>2024-01-{n % 28 + 1:02d}</lastmod><changefreq>weekly</changefreq>"
+                         f"<priority>0.{n % 10}</priority></url>\n")
+        parts.append('</urlset>\n')
+        return ''.join(parts).encode()
+
+
+def make_handler(site):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if site.latency:
+                time.sleep(site.latency)
+            path = self.path.split('?', 1)[0]
+            if site.profile == 'failing':
+                return self.empty(500)
+            if site.profile == 'flaky' and path.startswith('/child-'):
+                if int(path[len('/child-'):].split('.')[0]) % 3 == 0:
+                    return self.empty(500)
+            found = site.body(path)
+            if found is None:
+                return self.empty(404)
+            body, content_type = found
+            etag = '"%08x"' % zlib.crc32(body)
+            if self.headers.get('If-None-Match') == etag:
+                return self.empty(304, etag)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', LAST_MODIFIED)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def empty(self, status, etag=None):
+            self.send_response(status)
+            if etag:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    return Handler
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(profiles, options):
+    """Start one server per profile, return [(profile, domain)] and the servers"""
+    sites = []
+    servers = []
+    for profile in profiles:
+        if profile == 'dead':
+            sites.append((profile, f"127.0.0.1:{closed_port()}"))
+            continue
+        server = ThreadingHTTPServer(('127.0.0.1', 0), None)
+        server.daemon_threads = True
+        server.RequestHandlerClass = make_handler(Site(profile, server.server_port, options))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        sites.append((profile, f"127.0.0.1:{server.server_port}"))
+    return sites, servers
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Synthetic sitemap hosts")
+    parser.add_argument('--sites', default='fast:4,slow:1,flaky:1,failing:1,dead:1')
+    parser.add_argument('--children', type=int, default=20, help="child sitemaps per site")
+    parser.add_argument('--urls', type=int, default=1000, help="URLs per child sitemap")
+    parser.add_argument('--huge-urls', type=int, default=1_000_000)
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds added to every response")
+    parser.add_argument('--slow-latency', type=float, default=0.25, help="extra seconds for slow sites")
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    sites, _ = start(parse_sites(options.sites), options)
+    print(json.dumps({"sites": [{"profile": profile, "domain": domain} for profile, domain in sites]}),
+          flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()